@@ -0,0 +1,21 @@
+"""
+Code shared by the scripts: lazy imports, so `--help` and small queries don't
+pay for boto3, rich and the other heavy modules, the cached AWS
+session/client factory, the retries with backoff and the atomic file writes
+"""
+
+from aws_common.files import atomic_write
+from aws_common.lazy import LazyObject, lazy_import
+from aws_common.retries import backoff, retry
+from aws_common.session import AWS, get_client, get_session
+
+__all__ = [
+    "AWS",
+    "LazyObject",
+    "atomic_write",
+    "backoff",
+    "get_client",
+    "get_session",
+    "lazy_import",
+    "retry",
+]
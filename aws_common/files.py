@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+# Read once, os.umask can only be read by changing it (not thread safe later)
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def atomic_write(path, content, mode=None, fsync=False):
+    """
+    Write content (str or bytes) on path through a temporary file unique to
+    this writer, on the same directory, renamed over it: readers never see a
+    partial file and concurrent writers don't remove each other's files.
+    Without mode, the file keeps its current mode (new files follow the umask)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_umask
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        os.chmod(temp_path, mode)
+        binary = isinstance(content, bytes)
+        with os.fdopen(
+            file_descriptor,
+            "wb" if binary else "w",
+            encoding=None if binary else "utf-8",
+        ) as temp_file:
+            temp_file.write(content)
+            if fsync:
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,96 @@
+"""
+Measure the startup of each script running `--help` and fail when it's over
+the budget. The slowest imports of each script are shown with -X importtime
+
+    python -m aws_common.import_budget --budget 300
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SCRIPTS = [
+    os.path.join("migrate-ecr-images", "main.py"),
+    os.path.join("get-ec2-win-pass", "get-ec2-win-pass.py"),
+    os.path.join("sso-credentials", "sso-credentials.py"),
+]
+
+
+def elapsed(command):
+    started = time.perf_counter()
+    subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
+    return (time.perf_counter() - started) * 1000
+
+
+def slowest_imports(script, quantity):
+    """
+    Top level imports of the script (the ones done by the script itself)
+    ordered by their cumulative time in milliseconds
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", script, "--help"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith(" ") or name.startswith("  "):
+            continue
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:quantity]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=300,
+        help='Maximum startup time in milliseconds (default: "%(default)s")',
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help='Executions of each script, the median is used (default: "%(default)s")',
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help='Slowest imports shown for each script (default: "%(default)s")',
+    )
+    args = parser.parse_args()
+
+    baseline = statistics.median(
+        elapsed([sys.executable, "-c", "pass"]) for _ in range(args.runs)
+    )
+    print(f"Python startup: {baseline:.0f} ms | budget: {args.budget:.0f} ms")
+    over_budget = []
+    for script in SCRIPTS:
+        path = os.path.normpath(os.path.join(ROOT, script))
+        startup = statistics.median(
+            elapsed([sys.executable, path, "--help"]) for _ in range(args.runs)
+        )
+        status = "ok" if startup <= args.budget else "OVER BUDGET"
+        print(f"{script}: {startup:.0f} ms ({status})")
+        for cumulative, name in slowest_imports(path, args.top):
+            print(f"    {cumulative:8.1f} ms  {name}")
+        if startup > args.budget:
+            over_budget.append(script)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import importlib
+import sys
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module imported on the first attribute access. The import itself is
+    done by importlib, so it's safe when many threads use it at same time
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_LazyModule__module"] = None
+
+    def __getattr__(self, attribute):
+        module = self.__module
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_LazyModule__module"] = module
+        return getattr(module, attribute)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name):
+    """
+    Return the module if already imported, otherwise a LazyModule that
+    imports it only when used. The scripts import their heavy modules (boto3,
+    rich, bs4...) this way, so --help and the argument errors are fast
+    """
+    return sys.modules.get(name) or LazyModule(name)
+
+
+class LazyObject:
+    """
+    Object created by factory on the first use, used for module level
+    objects (console, progress bars) whose classes are heavy to import
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_LazyObject__factory", factory)
+        object.__setattr__(self, "_LazyObject__instance", None)
+        object.__setattr__(self, "_LazyObject__lock", threading.Lock())
+
+    @property
+    def __wrapped__(self):
+        if self.__instance is None:
+            with self.__lock:
+                if self.__instance is None:
+                    object.__setattr__(self, "_LazyObject__instance", self.__factory())
+        return self.__instance
+
+    def __getattr__(self, attribute):
+        return getattr(self.__wrapped__, attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.__wrapped__, attribute, value)
+
+    def __enter__(self):
+        return self.__wrapped__.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.__wrapped__.__exit__(*exc_info)
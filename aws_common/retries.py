@@ -0,0 +1,26 @@
+import random
+import time
+
+
+def backoff(attempt, base=0.5, cap=20.0):
+    """
+    Full jitter backoff: a random wait up to base * 2^attempt, limited by cap
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retry(operation, should_retry, max_attempts=8, on_retry=None):
+    """
+    Execute operation until it succeeds, retrying the exceptions accepted by
+    should_retry (up to max_attempts) with full jitter backoff. on_retry is
+    called with the exception before each new attempt
+    """
+    for attempt in range(max_attempts):
+        try:
+            return operation()
+        except Exception as exc:
+            if attempt == max_attempts - 1 or not should_retry(exc):
+                raise
+            if on_retry:
+                on_retry(exc)
+        time.sleep(backoff(attempt))
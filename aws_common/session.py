@@ -0,0 +1,93 @@
+import threading
+
+from aws_common.lazy import lazy_import
+
+boto3 = lazy_import("boto3")
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+
+
+def get_session(
+    profile=None, region=None, access_key=None, secret_key=None, session_token=None
+):
+    """
+    boto3 Session cached by its arguments, so the credentials and the
+    botocore data are loaded once per process
+    """
+    key = (profile, region, access_key, secret_key, session_token)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            if profile:
+                session = boto3.Session(profile_name=profile, region_name=region)
+            else:
+                session = boto3.Session(
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    aws_session_token=session_token,
+                    region_name=region,
+                )
+            _sessions[key] = session
+    return session
+
+
+def get_client(service, region=None, config=None, session=None, **session_args):
+    """
+    Client cached by service, region and config on the session (cached too,
+    when session_args are used instead of a session)
+    """
+    if session is None:
+        session = get_session(region=region, **session_args)
+    key = (id(session), service, region, id(config) if config else None)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = session.client(service, region_name=region, config=config)
+            # Keep session and config alive, their ids are part of the key
+            _clients[key] = client, session, config
+        else:
+            client = client[0]
+    return client
+
+
+class AWS:
+    def __init__(
+        self,
+        access_key=None,
+        secret_key=None,
+        session_token=None,
+        profile=None,
+        region="us-east-1",
+        log=None,
+    ):
+        log = log or (lambda message: None)
+        log("Validating data to create session on AWS")
+        if profile:
+            if access_key and secret_key:
+                log(
+                    "Access Key, Secret Key and Session Token will be ignored. "
+                    "The Profile Name has greater precedence"
+                )
+            log(
+                f"Creating session on AWS with parameter Profile as [green]{profile}[/green]"
+            )
+            self.__session = get_session(profile=profile, region=region)
+        elif not access_key and not secret_key:
+            log(
+                "If Profile Name isn't defined, Access Key and Secret Key need to be defined"
+            )
+            raise EnvironmentError("Parameter defined incorrectly")
+        else:
+            log("Creating session on AWS with Access Key, Secret Key and Session Token")
+            self.__session = get_session(
+                region=region,
+                access_key=access_key,
+                secret_key=secret_key,
+                session_token=session_token,
+            )
+        log("Session created on AWS with success status")
+
+    def get_session(self):
+        return self.__session
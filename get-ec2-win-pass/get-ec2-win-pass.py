@@ -1,95 +1,39 @@
-from rich.progress import BarColumn, Progress, TimeElapsedColumn, TimeRemainingColumn
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from rich.console import Console
-from rich.rule import Rule
-from rich.table import Table
-from rich.style import Style
-from rich.align import Align
-from rich.live import Live
 import click
-import boto3
 import os
+import sys
 import base64
 
-
-console = Console(log_path=False)
-rule = Rule(
-    title="Start to collect Windows password from required key",
-    characters="-",
-    style="rule.line",
-    end="\n",
-    align="center",
-)
-progress = Progress(
-    "[progress.description]{task.description}",
-    BarColumn(),
-    "[progress.percentage]{task.percentage:>3.0f}%",
-    "•",
-    "[progress.completed]{task.completed}",
-    "|",
-    "[progress.total]{task.total}",
-    "•",
-    TimeRemainingColumn(),
-    "|",
-    TimeElapsedColumn(),
-    console=console,
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from aws_common import AWS, LazyObject, lazy_import  # noqa: E402
+
+padding = lazy_import("cryptography.hazmat.primitives.asymmetric.padding")
+serialization = lazy_import("cryptography.hazmat.primitives.serialization")
+rich_align = lazy_import("rich.align")
+rich_console = lazy_import("rich.console")
+rich_live = lazy_import("rich.live")
+rich_progress = lazy_import("rich.progress")
+rich_style = lazy_import("rich.style")
+rich_table = lazy_import("rich.table")
+
+console = LazyObject(lambda: rich_console.Console(log_path=False))
+progress = LazyObject(
+    lambda: rich_progress.Progress(
+        "[progress.description]{task.description}",
+        rich_progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        "•",
+        "[progress.completed]{task.completed}",
+        "|",
+        "[progress.total]{task.total}",
+        "•",
+        rich_progress.TimeRemainingColumn(),
+        "|",
+        rich_progress.TimeElapsedColumn(),
+        console=console.__wrapped__,
+    )
 )
 
 
-class AWS:
-    def __init__(
-        self,
-        access_key=None,
-        secret_key=None,
-        session_token=None,
-        profile=None,
-        region="us-east-1",
-    ):
-        self.__access_key = access_key
-        self.__secret_key = secret_key
-        self.__session_token = session_token
-        self.__profile = profile
-        self.__region = region
-        console.log("Validating data to create session on AWS")
-        if self.__profile:
-            if self.__access_key and self.__secret_key and self.__session_token:
-                console.log(
-                    "Access Key, Secret Key and Session Token will be ignored. "
-                    "The Profile Name precedence is more bigger."
-                )
-                pass
-
-            console.log(
-                f"Creating session on AWS with parameter Profile as [green]{self.__profile}[/green]"
-            )
-            self.__session = boto3.Session(
-                profile_name=self.__profile, region_name=self.__region
-            )
-            console.log("Session created on AWS with success status")
-        elif (
-            not self.__access_key and not self.__secret_key and not self.__session_token
-        ):
-            console.log(
-                "If Profile Name not be defined, Access Key, Secret Key and Session Token need to be defined"
-            )
-            raise EnvironmentError("Parameters defined incorrectly")
-        else:
-            console.log(
-                "Creating session on AWS with Access Key, Secret Key and Session Token"
-            )
-            self.__session = boto3.Session(
-                aws_access_key_id=self.__access_key,
-                aws_secret_access_key=self.__secret_key,
-                aws_session_token=self.__session_token,
-                region_name=self.__region,
-            )
-            console.log("Session created on AWS with success status")
-
-    def get_session(self):
-        return self.__session
-
-
 class Crypt:
     def __init__(self, pem_file):
         self.pem_file = pem_file
@@ -97,7 +41,7 @@ class Crypt:
 
     def load_pem_file(self):
         with open(self.pem_file, "rb") as pem:
-            return load_pem_private_key(pem.read(), password=None)
+            return serialization.load_pem_private_key(pem.read(), password=None)
 
     def decrypt(self, data):
         return self.pem_data.decrypt(data, padding.PKCS1v15()).decode("utf-8")
@@ -158,6 +102,7 @@ def main(
         access_key=access_key,
         secret_key=secret_key,
         session_token=session_token,
+        log=console.log,
     ).get_session()
     if os.path.exists(pem_file) and os.path.isfile(pem_file):
         file_name = os.path.basename(pem_file)
@@ -175,7 +120,7 @@ def main(
 
     else:
         console.log(
-            f"List EC2 instances with Key Pair: [magenta]{file_name.split(".")[0]}[/magenta]"
+            f"List EC2 instances with Key Pair: [magenta]{file_name.split('.')[0]}[/magenta]"
         )
         client = aws_session.client("ec2")
         instance_list = client.describe_instances(
@@ -191,7 +136,7 @@ def main(
                         windows_instances.append(instance)
                     else:
                         console.log(
-                            f"Instance [magenta]{instance["InstanceId"]}[/magenta] isn't [magenta]Running[/magenta]. [bold red]This instance will be ignored.[/bold red]"
+                            f"Instance [magenta]{instance['InstanceId']}[/magenta] isn't [magenta]Running[/magenta]. [bold red]This instance will be ignored.[/bold red]"
                         )
         if len(windows_instances) > 0:
             instances_progress = progress.add_task(
@@ -218,23 +163,25 @@ def main(
             console.log("Required instances isn't running Windows")
 
     if len(windows_instances) > 0:
-        table = Table(
+        table = rich_table.Table(
             show_header=True,
             header_style="bold green",
             show_footer=False,
             title="Windows Instances Password Data",
         )
-        table_centered = Align.left(table)
+        table_centered = rich_align.Align.left(table)
 
-        with Live(table_centered, console=console, screen=False, refresh_per_second=20):
+        with rich_live.Live(
+            table_centered, console=console, screen=False, refresh_per_second=20
+        ):
             table.add_column("Instance ID", justify="center")
             table.add_column("Name", justify="left")
             table.add_column("IP Address", justify="left")
             table.add_column("User", justify="left")
             table.add_column("Password", justify="left")
             table.row_styles = [
-                Style(bgcolor="gray74", color="black"),
-                Style(bgcolor="gray82", color="black"),
+                rich_style.Style(bgcolor="gray74", color="black"),
+                rich_style.Style(bgcolor="gray82", color="black"),
             ]
             for item in instance_data:
                 table.add_row(
@@ -0,0 +1,661 @@
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+import click
+from botocore.exceptions import ClientError
+from collections import Counter
+from rich.align import Align
+from rich.console import Console
+from rich.table import Table
+
+console = Console(log_path=False)
+
+PATTERN_SIZE = 64 * 1024
+
+
+def synthetic_pattern(seed):
+    block = hashlib.sha256(seed.encode("utf-8")).digest()
+    return block * (PATTERN_SIZE // len(block))
+
+
+class SyntheticBlob:
+    """
+    Layer content generated from a seed, never held in memory as a whole
+    """
+
+    def __init__(self, seed, size):
+        self.seed = seed
+        self.size = size
+        self.pattern = synthetic_pattern(seed)
+        digest = hashlib.sha256()
+        for chunk in self.chunks():
+            digest.update(chunk)
+        self.digest = f"sha256:{digest.hexdigest()}"
+
+    def chunks(self, first_byte=0):
+        position = first_byte
+        while position < self.size:
+            offset = position % PATTERN_SIZE
+            size = min(PATTERN_SIZE - offset, self.size - position)
+            yield self.pattern[offset : offset + size]
+            position += size
+
+
+class SyntheticRegistry:
+    """
+    In-memory stand-in for an ECR registry with N repositories of M images,
+    each image with one config, shared base layers and its own layers
+    """
+
+    def __init__(
+        self,
+        repositories=0,
+        images=0,
+        layers=4,
+        base_layers=2,
+        layer_size=1024 * 1024,
+    ):
+        self.lock = threading.Lock()
+        self.repositories = {}
+        self.blobs = {}
+        self.layers = {}
+        base = [
+            self.add_blob(f"base-{index}", layer_size) for index in range(base_layers)
+        ]
+        for repo_index in range(repositories):
+            repository_name = f"repository-{repo_index:05d}"
+            self.repositories[repository_name] = {}
+            for image_index in range(images):
+                seed = f"{repository_name}-{image_index}"
+                own = [
+                    self.add_blob(f"{seed}-{index}", layer_size)
+                    for index in range(max(0, layers - base_layers))
+                ]
+                config = self.add_blob(f"{seed}-config", 1024)
+                self.add_image(repository_name, config, base + own, [f"v{image_index}"])
+
+    def add_blob(self, seed, size):
+        blob = SyntheticBlob(seed, size)
+        self.blobs[blob.digest] = blob
+        return blob
+
+    def add_image(self, repository_name, config, layers, tags):
+        manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                "config": {
+                    "mediaType": "application/vnd.docker.container.image.v1+json",
+                    "size": config.size,
+                    "digest": config.digest,
+                },
+                "layers": [
+                    {
+                        "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                        "size": layer.size,
+                        "digest": layer.digest,
+                    }
+                    for layer in layers
+                ],
+            }
+        )
+        digest = f"sha256:{hashlib.sha256(manifest.encode('utf-8')).hexdigest()}"
+        self.repositories[repository_name][digest] = {
+            "manifest": manifest,
+            "tags": list(tags),
+            "size": config.size + sum(layer.size for layer in layers),
+            "pushed_at": datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+            + datetime.timedelta(hours=len(self.repositories[repository_name])),
+        }
+        self.layers.setdefault(repository_name, set()).update(
+            [config.digest] + [layer.digest for layer in layers]
+        )
+        return digest
+
+
+class SimulatedExceptions:
+
+    def __init__(self):
+        for name in [
+            "RepositoryAlreadyExistsException",
+            "ImageAlreadyExistsException",
+            "LayerAlreadyExistsException",
+            "RepositoryNotFoundException",
+        ]:
+            setattr(self, name, type(name, (ClientError,), {}))
+
+
+class SimulatedECRClient:
+    """
+    ECR client answering from a SyntheticRegistry, with latency per call,
+    pagination and random throttling
+    """
+
+    def __init__(self, registry, latency=0.0, throttle_rate=0.0, page_size=100):
+        self.registry = registry
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.exceptions = SimulatedExceptions()
+        self.calls = Counter()
+        self.throttles = Counter()
+        self.uploads = {}
+        # Never reused, finished uploads are removed while others are open
+        self.__upload_ids = itertools.count()
+        self.__lock = threading.Lock()
+
+    def __call(self, operation):
+        with self.__lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        describe = operation.startswith(("Describe", "List"))
+        if describe and self.throttle_rate and random.random() < self.throttle_rate:
+            with self.__lock:
+                self.throttles[operation] += 1
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+                operation,
+            )
+
+    def __error(self, name, operation):
+        raise getattr(self.exceptions, name)(
+            {"Error": {"Code": name, "Message": name}}, operation
+        )
+
+    def __page(self, items, next_token, page_size=None):
+        start = int(next_token or 0)
+        end = start + (page_size or self.page_size)
+        return items[start:end], str(end) if end < len(items) else None
+
+    def describe_repositories(self, repositoryNames=None, nextToken=None):
+        self.__call("DescribeRepositories")
+        names = sorted(self.registry.repositories)
+        if repositoryNames:
+            names = [name for name in names if name in repositoryNames]
+        page, next_token = self.__page(names, nextToken)
+        response = {"repositories": [{"repositoryName": name} for name in page]}
+        if next_token:
+            response["nextToken"] = next_token
+        return response
+
+    def describe_images(
+        self, repositoryName, filter=None, imageIds=None, nextToken=None
+    ):
+        self.__call("DescribeImages")
+        images = sorted(self.registry.repositories[repositoryName].items())
+        if imageIds:
+            digests = {image_id["imageDigest"] for image_id in imageIds}
+            images = [image for image in images if image[0] in digests]
+        page, next_token = self.__page(images, nextToken)
+        response = {
+            "imageDetails": [
+                {
+                    "imageDigest": digest,
+                    "imageTags": image["tags"],
+                    "imagePushedAt": image["pushed_at"],
+                    "imageSizeInBytes": image["size"],
+                }
+                for digest, image in page
+            ]
+        }
+        if next_token:
+            response["nextToken"] = next_token
+        return response
+
+    def list_images(self, repositoryName, filter=None, maxResults=100, nextToken=None):
+        self.__call("ListImages")
+        image_ids = [
+            {"imageDigest": digest, "imageTag": tag}
+            for digest, image in sorted(
+                self.registry.repositories[repositoryName].items()
+            )
+            for tag in image["tags"]
+        ]
+        page, next_token = self.__page(image_ids, nextToken, maxResults)
+        response = {"imageIds": page}
+        if next_token:
+            response["nextToken"] = next_token
+        return response
+
+    def create_repository(self, repositoryName):
+        self.__call("CreateRepository")
+        with self.registry.lock:
+            if repositoryName in self.registry.repositories:
+                self.__error("RepositoryAlreadyExistsException", "CreateRepository")
+            self.registry.repositories[repositoryName] = {}
+        return {"repository": {"repositoryName": repositoryName}}
+
+    def batch_get_image(self, repositoryName, imageIds, acceptedMediaTypes=None):
+        self.__call("BatchGetImage")
+        images = []
+        failures = []
+        for image_id in imageIds:
+            image = self.registry.repositories[repositoryName].get(
+                image_id["imageDigest"]
+            )
+            if image:
+                images.append(
+                    {
+                        "imageId": image_id,
+                        "imageManifest": image["manifest"],
+                        "imageManifestMediaType": json.loads(image["manifest"])[
+                            "mediaType"
+                        ],
+                    }
+                )
+            else:
+                failures.append(
+                    {
+                        "imageId": image_id,
+                        "failureCode": "ImageNotFound",
+                        "failureReason": "Requested image not found",
+                    }
+                )
+        return {"images": images, "failures": failures}
+
+    def batch_check_layer_availability(self, repositoryName, layerDigests):
+        self.__call("BatchCheckLayerAvailability")
+        available = self.registry.layers.get(repositoryName, set())
+        return {
+            "layers": [
+                {
+                    "layerDigest": digest,
+                    "layerAvailability": (
+                        "AVAILABLE" if digest in available else "UNAVAILABLE"
+                    ),
+                }
+                for digest in layerDigests
+            ],
+            "failures": [],
+        }
+
+    def get_download_url_for_layer(self, repositoryName, layerDigest):
+        self.__call("GetDownloadUrlForLayer")
+        return {"downloadUrl": f"simulated://{layerDigest}", "layerDigest": layerDigest}
+
+    def initiate_layer_upload(self, repositoryName):
+        self.__call("InitiateLayerUpload")
+        with self.__lock:
+            upload_id = str(next(self.__upload_ids))
+            self.uploads[upload_id] = [hashlib.sha256(), 0]
+        return {"uploadId": upload_id, "partSize": 10 * 1024 * 1024}
+
+    def upload_layer_part(
+        self, repositoryName, uploadId, partFirstByte, partLastByte, layerPartBlob
+    ):
+        self.__call("UploadLayerPart")
+        upload = self.uploads[uploadId]
+        upload[0].update(layerPartBlob)
+        upload[1] = partLastByte + 1
+        return {"uploadId": uploadId, "lastByteReceived": partLastByte}
+
+    def complete_layer_upload(self, repositoryName, uploadId, layerDigests):
+        self.__call("CompleteLayerUpload")
+        digest = f"sha256:{self.uploads.pop(uploadId)[0].hexdigest()}"
+        if digest != layerDigests[0]:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "InvalidLayerException",
+                        "Message": "Digest mismatch",
+                    }
+                },
+                "CompleteLayerUpload",
+            )
+        with self.registry.lock:
+            self.registry.layers.setdefault(repositoryName, set()).add(digest)
+        return {"layerDigest": digest}
+
+    def put_image(
+        self,
+        repositoryName,
+        imageManifest,
+        imageDigest=None,
+        imageTag=None,
+        imageManifestMediaType=None,
+    ):
+        self.__call("PutImage")
+        with self.registry.lock:
+            images = self.registry.repositories[repositoryName]
+            image = images.setdefault(
+                imageDigest,
+                {
+                    "manifest": imageManifest,
+                    "tags": [],
+                    "size": 0,
+                    "pushed_at": datetime.datetime.now(datetime.timezone.utc),
+                },
+            )
+            if imageTag and imageTag not in image["tags"]:
+                image["tags"].append(imageTag)
+        return {
+            "image": {"imageId": {"imageDigest": imageDigest, "imageTag": imageTag}}
+        }
+
+
+class SimulatedSession:
+
+    def __init__(self, client, region="us-east-1"):
+        self.__client = client
+        self.region_name = region
+
+    def client(self, service_name, **kwargs):
+        return self.__client
+
+
+class SimulatedResponse:
+
+    def __init__(self, blob, first_byte=0):
+        self.status = 206 if first_byte else 200
+        self.__chunks = blob.chunks(first_byte)
+        self.__pending = memoryview(b"")
+
+    def readinto(self, buffer):
+        if not self.__pending:
+            self.__pending = memoryview(next(self.__chunks, b""))
+        size = min(len(buffer), len(self.__pending))
+        buffer[:size] = self.__pending[:size]
+        self.__pending = self.__pending[size:]
+        return size
+
+    def release_conn(self):
+        pass
+
+
+class SimulatedHttp:
+
+    def __init__(self, registry, latency=0.0):
+        self.registry = registry
+        self.latency = latency
+
+    def request(self, method, url, headers=None, preload_content=True):
+        if self.latency:
+            time.sleep(self.latency)
+        blob = self.registry.blobs[url.split("://", 1)[1]]
+        first_byte = 0
+        if headers and "Range" in headers:
+            first_byte = int(headers["Range"].split("=")[1].split("-")[0])
+        return SimulatedResponse(blob, first_byte)
+
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is KB on Linux and bytes on macOS
+    scale = 1 if os.uname().sysname == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def run_scenario(scenario):
+    """
+    Execute one scenario on a fresh process, so the peak RSS is its own
+    """
+    import main
+
+    main.console.quiet = True
+    main.progress.disable = True
+    random.seed(scenario["seed"])
+    source_registry = SyntheticRegistry(
+        repositories=scenario["repositories"],
+        images=scenario["images"],
+        layers=scenario["layers"],
+        base_layers=scenario["base_layers"],
+        layer_size=scenario["layer_size"],
+    )
+    source_client = SimulatedECRClient(
+        source_registry,
+        latency=scenario["latency"],
+        throttle_rate=scenario["throttle_rate"],
+        page_size=scenario["page_size"],
+    )
+    threads = scenario["threads"]
+    concurrency = main.AdaptiveConcurrency(maximum=threads)
+    ecr = main.ECR(
+        aws_session=SimulatedSession(source_client),
+        concurrency=concurrency,
+        max_pool_connections=threads,
+        http=SimulatedHttp(source_registry, latency=scenario["latency"]),
+    )
+    result = {"threads": threads}
+
+    started = time.perf_counter()
+    store = main.ImageStore()
+    repo_list = []
+    report = main.StreamReport(output_format="jsonl", path=os.devnull, per_image=True)
+    with report.live():
+
+        def repo_tuple_iter():
+            for repo in ecr.iter_repositories(store=store):
+                repo_list.append(repo)
+                yield main.Image(
+                    aws=ecr, repo=repo, report=report, journal=None, inventory=None
+                )
+
+        worker = main.Worker(concurrent_threads=threads, concurrency=concurrency)
+        worker.run(main.multi_thread_images, repo_tuple_iter())
+    result["list_seconds"] = time.perf_counter() - started
+    result["list_calls"] = sum(source_client.calls.values())
+    result["images"] = store.total_count
+    result["concurrency"] = int(concurrency.limit)
+
+    if scenario["migrate"]:
+        destination_client = SimulatedECRClient(
+            SyntheticRegistry(),
+            latency=scenario["latency"],
+            page_size=scenario["page_size"],
+        )
+        destination = main.ECR(
+            aws_session=SimulatedSession(destination_client),
+            max_pool_connections=threads,
+        )
+        started = time.perf_counter()
+        source_calls = sum(source_client.calls.values())
+        results = main.migrate_destination(
+            ecr,
+            destination,
+            repo_list,
+            main.BufferPool(
+                chunk_size=scenario["chunk_size"],
+                max_in_flight=scenario["max_in_flight"],
+            ),
+            threads,
+        )
+        result["migrate_seconds"] = time.perf_counter() - started
+        result["migrate_calls"] = (
+            sum(source_client.calls.values())
+            - source_calls
+            + sum(destination_client.calls.values())
+        )
+        result["migrated_images"] = len(results)
+        result["bytes_copied"] = sum(item.bytes_copied for item in results)
+
+    result["throttles"] = sum(source_client.throttles.values())
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+@click.command()
+@click.option(
+    "--repositories",
+    default=200,
+    show_default=True,
+    type=int,
+    help="Synthetic repositories quantity",
+)
+@click.option(
+    "--images", default=20, show_default=True, type=int, help="Images per repository"
+)
+@click.option(
+    "--layers", default=4, show_default=True, type=int, help="Layers per image"
+)
+@click.option(
+    "--base-layers",
+    default=2,
+    show_default=True,
+    type=int,
+    help="Layers shared by all images",
+)
+@click.option(
+    "--layer-size", default=1, show_default=True, type=float, help="Layer size in MB"
+)
+@click.option(
+    "--latency",
+    default=20,
+    show_default=True,
+    type=float,
+    help="Latency in milliseconds added to each call",
+)
+@click.option(
+    "--throttle-rate",
+    default=0.0,
+    show_default=True,
+    type=float,
+    help="Share of describe calls answered with ThrottlingException",
+)
+@click.option(
+    "--page-size",
+    default=100,
+    show_default=True,
+    type=int,
+    help="Items per page on the describe calls",
+)
+@click.option(
+    "--threads",
+    default=[10, 50],
+    show_default=True,
+    type=int,
+    multiple=True,
+    help="Threads quantity to benchmark, can be repeated",
+)
+@click.option(
+    "--migrate",
+    is_flag=True,
+    default=False,
+    help="Benchmark the migration after the listing",
+)
+@click.option(
+    "--chunk-size",
+    default=20,
+    show_default=True,
+    type=int,
+    help="Layer part size in MB",
+)
+@click.option(
+    "--max-in-flight",
+    default=500,
+    show_default=True,
+    type=int,
+    help="Layer data in MB buffered by all threads",
+)
+@click.option(
+    "--seed",
+    default=42,
+    show_default=True,
+    type=int,
+    help="Random seed used for the throttling",
+)
+@click.option(
+    "--output-file", help="Write the results as JSON on this file", required=False
+)
+def benchmark(
+    repositories,
+    images,
+    layers,
+    base_layers,
+    layer_size,
+    latency,
+    throttle_rate,
+    page_size,
+    threads,
+    migrate,
+    chunk_size,
+    max_in_flight,
+    seed,
+    output_file,
+):
+    """
+    Benchmark the listing and migration against a simulated ECR registry,
+    without any AWS account
+    """
+    results = []
+    for thread_quantity in threads:
+        scenario = {
+            "repositories": repositories,
+            "images": images,
+            "layers": layers,
+            "base_layers": min(base_layers, layers),
+            "layer_size": int(layer_size * 1024 * 1024),
+            "latency": latency / 1000,
+            "throttle_rate": throttle_rate,
+            "page_size": page_size,
+            "threads": thread_quantity,
+            "migrate": migrate,
+            "chunk_size": chunk_size * 1024 * 1024,
+            "max_in_flight": max_in_flight * 1024 * 1024,
+            "seed": seed,
+        }
+        console.log(f"Running scenario with {thread_quantity} threads")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results.append(executor.submit(run_scenario, scenario).result())
+
+    table = Table(
+        show_header=True,
+        header_style="bold green",
+        show_footer=False,
+        title="Benchmark Results",
+    )
+    headers = [
+        "Threads",
+        "List Time",
+        "List Calls/s",
+        "Images/s",
+        "Throttles",
+        "Final Concurrency",
+    ]
+    if migrate:
+        headers += ["Migrate Time", "Migrate Calls/s", "Throughput"]
+    headers.append("Peak RSS")
+    for header in headers:
+        table.add_column(header, justify="center")
+
+    from main import readable_size
+
+    for result in results:
+        row = [
+            str(result["threads"]),
+            f"{result['list_seconds']:.2f}s",
+            f"{result['list_calls'] / result['list_seconds']:.1f}",
+            f"{result['images'] / result['list_seconds']:.1f}",
+            str(result["throttles"]),
+            str(result["concurrency"]),
+        ]
+        if migrate:
+            row += [
+                f"{result['migrate_seconds']:.2f}s",
+                f"{result['migrate_calls'] / result['migrate_seconds']:.1f}",
+                f"{readable_size(result['bytes_copied'] / result['migrate_seconds'])}/s",
+            ]
+        row.append(readable_size(result["peak_rss"]) if result["peak_rss"] else "-")
+        table.add_row(*row)
+    console.print(Align.center(table))
+
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as results_file:
+            json.dump(results, results_file, indent=2)
+        console.log(f"Results saved: {output_file}")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,24 +1,90 @@
-import boto3
 import json
 import os
 import re
 import click
-from rich.progress import (
-    BarColumn,
-    Progress,
-    TimeElapsedColumn,
-    TimeRemainingColumn,
-)
-from rich.console import Console
-from rich.rule import Rule
-from rich.table import Table
-from rich.style import Style
-from rich.live import Live
-from rich.align import Align
+import array
+import bisect
 import concurrent.futures
+import csv
+import contextlib
+import datetime
+import hashlib
+import heapq
+import multiprocessing
+import queue
+import socket
+import sqlite3
+import sys
+import threading
+import time
 from collections import namedtuple
 
-console = Console(log_path=False)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from aws_common import (  # noqa: E402
+    AWS,
+    LazyObject,
+    atomic_write,
+    get_session,
+    lazy_import,
+    retry,
+)
+
+botocore_config = lazy_import("botocore.config")
+botocore_exceptions = lazy_import("botocore.exceptions")
+urllib3 = lazy_import("urllib3")
+rich_align = lazy_import("rich.align")
+rich_console = lazy_import("rich.console")
+rich_live = lazy_import("rich.live")
+rich_progress = lazy_import("rich.progress")
+rich_style = lazy_import("rich.style")
+rich_table = lazy_import("rich.table")
+
+console = LazyObject(lambda: rich_console.Console(log_path=False))
+progress = LazyObject(
+    lambda: rich_progress.Progress(
+        "[progress.description]{task.description}",
+        rich_progress.BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        "•",
+        rich_progress.DownloadColumn(),
+        "•",
+        rich_progress.TransferSpeedColumn(),
+        "•",
+        "{task.fields[images]} images",
+        "•",
+        rich_progress.TimeRemainingColumn(),
+        "|",
+        rich_progress.TimeElapsedColumn(),
+        console=console.__wrapped__,
+    )
+)
+
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+MANIFEST_INDEX_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+THROTTLING_ERRORS = [
+    "ThrottlingException",
+    "Throttling",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+]
+# Describe calls are retried by ECR.call (throttling, 5xx and network errors),
+# so throttling reaches the adaptive concurrency instead of being hidden by
+# the botocore retries
+DESCRIBE_CLIENT_RETRIES = {"mode": "standard", "total_max_attempts": 1}
+FOREIGN_LAYER_MEDIA_TYPES = [
+    "application/vnd.docker.image.rootfs.foreign.diff.tar.gzip",
+    "application/vnd.oci.image.layer.nondistributable.v1.tar",
+    "application/vnd.oci.image.layer.nondistributable.v1.tar+gzip",
+]
 
 
 def readable_size(num):
@@ -29,58 +95,118 @@ def readable_size(num):
     return "{:3.1f}TB".format(num)
 
 
-class AWS:
+class ECR:
     def __init__(
         self,
-        access_key=None,
-        secret_key=None,
-        profile=None,
-        region="us-east-1",
+        aws_session,
+        concurrency=None,
+        max_attempts=8,
+        account=None,
+        max_pool_connections=10,
+        http=None,
+        metrics=None,
     ):
-        self.__access_key = access_key
-        self.__secret_key = secret_key
-        self.__profile = profile
-        self.__region = region
-        console.log("Validating data to create session on AWS")
-        if self.__profile:
-            if self.__access_key and self.__secret_key:
-                console.log(
-                    "Access Key and Secret Key will be ignored. "
-                    "The Profile Name has greater precedence"
-                )
-            console.log("Creating session on AWS with parameter Profile")
-            self.__session = boto3.Session(
-                profile_name=self.__profile, region_name=self.__region
-            )
-            console.log("Session created on AWS with success status")
-        elif not self.__access_key and not self.__secret_key:
-            console.log(
-                "If Profile Name isn't defined, Access Key and Secret Key need to be defined"
-            )
-            raise EnvironmentError("Parameter defined incorrectly")
-        else:
-            console.log(
-                "Creating session on AWS with Access Key, Secret Key and Session Token"
-            )
-            self.__session = boto3.Session(
-                aws_access_key_id=self.__access_key,
-                aws_secret_access_key=self.__secret_key,
-            )
-            console.log("Session created on AWS with success status")
+        self.__session = aws_session
+        self.__http = http or urllib3.PoolManager(maxsize=max_pool_connections)
+        self.__clients = {}
+        self.__lock = threading.Lock()
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.account = account
+        self.region = aws_session.region_name
+        self.max_pool_connections = max_pool_connections
+        self.metrics = metrics
 
-    def get_session(self):
-        return self.__session
+    def client(self, describe=False):
+        """
+        Return the ECR client of this session, created once and shared by all
+        threads (boto3 clients are thread safe, the session isn't) with a
+        keep-alive connection pool sized to the worker concurrency
+        """
+        key = "describe" if describe else "default"
+        client = self.__clients.get(key)
+        if client is None:
+            with self.__lock:
+                client = self.__clients.get(key)
+                if client is None:
+                    config = botocore_config.Config(
+                        max_pool_connections=self.max_pool_connections,
+                        tcp_keepalive=True,
+                    )
+                    if describe:
+                        config = config.merge(
+                            botocore_config.Config(retries=DESCRIBE_CLIENT_RETRIES)
+                        )
+                    client = self.__session.client("ecr", config=config)
+                    if self.metrics:
+                        self.metrics.register(client)
+                    self.__clients[key] = client
+        return client
 
+    def call(self, operation, **params):
+        """
+        Execute an API call retrying throttling, server (5xx) and network
+        errors with full jitter backoff
 
-class ECR:
-    def __init__(self, aws_session):
-        self.__session = aws_session
+        Latency and throttling are reported to the adaptive concurrency, when defined
+        """
+
+        def attempt():
+            started = time.monotonic()
+            response = operation(**params)
+            if self.concurrency:
+                self.concurrency.on_success(time.monotonic() - started)
+            return response
 
-    def list_repositories(self, filter_type=None, filter=None):
-        client = self.__session.client("ecr")
+        def should_retry(exc):
+            if isinstance(
+                exc,
+                (
+                    botocore_exceptions.ConnectionError,
+                    botocore_exceptions.HTTPClientError,
+                ),
+            ):
+                return True
+            if not isinstance(exc, botocore_exceptions.ClientError):
+                return False
+            if exc.response["Error"]["Code"] in THROTTLING_ERRORS:
+                if self.concurrency:
+                    self.concurrency.on_throttle()
+                return True
+            status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            return bool(status) and status >= 500
+
+        def on_retry(exc):
+            if self.metrics:
+                # Same name of the botocore events (DescribeImages, not describe_images)
+                meta = getattr(getattr(operation, "__self__", None), "meta", None)
+                name = getattr(meta, "method_to_api_mapping", {}).get(
+                    operation.__name__, operation.__name__
+                )
+                self.metrics.add_retry(name)
+
+        return retry(
+            attempt, should_retry, max_attempts=self.max_attempts, on_retry=on_retry
+        )
+
+    def list_repositories(self, filter_type=None, filter=None, store=None):
+        return list(
+            self.iter_repositories(filter_type=filter_type, filter=filter, store=store)
+        )
+
+    def iter_repositories(self, filter_type=None, filter=None, store=None):
+        """
+        Yield the filtered repositories as each page arrives, so the images
+        can be described while the next pages are still being listed
+        """
+        client = self.client(describe=True)
         next_token = None
         flag_run = True
-        repo_list_filtered = []
+        repo_count = 0
+        if filter_type in ["regex", "regex-not"]:
+            pattern = re.compile(filter)
+        elif filter_type == "common-not":
+            names = set(filter)
         console.log("Listing ECR repositories")
         while flag_run:
             if filter_type == "common":
@@ -88,57 +214,96 @@ class ECR:
                     console.log(
                         "List repositories without Next Token with Common strategy"
                     )
-                    repo_list = client.describe_repositories(repositoryNames=filter)
+                    repo_list = self.call(
+                        client.describe_repositories, repositoryNames=filter
+                    )
                 else:
                     console.log(
                         "List repositories with Next Token with Common strategy"
                     )
-                    repo_list = client.describe_repositories(
-                        repositoryNames=filter, nextToken=next_token
+                    repo_list = self.call(
+                        client.describe_repositories,
+                        repositoryNames=filter,
+                        nextToken=next_token,
                     )
             else:
                 if not next_token:
                     console.log("List all ECR repositories without Next Token")
-                    repo_list = client.describe_repositories()
+                    repo_list = self.call(client.describe_repositories)
                 else:
                     console.log("List all ECR repositories with Next Token")
-                    repo_list = client.describe_repositories(nextToken=next_token)
+                    repo_list = self.call(
+                        client.describe_repositories, nextToken=next_token
+                    )
+            if "nextToken" in repo_list:
+                next_token = repo_list["nextToken"]
+            else:
+                flag_run = False
             console.log("Filtering repositories...")
             for repo in repo_list["repositories"]:
+                name = repo["repositoryName"]
                 if filter_type == "regex":
-                    if re.search(filter, repo["repositoryName"]):
-                        repo_list_filtered.append(repo["repositoryName"])
+                    if not pattern.search(name):
+                        continue
                 elif filter_type == "common-not":
-                    if repo["repositoryName"] not in filter:
-                        repo_list_filtered.append(repo["repositoryName"])
+                    if name in names:
+                        continue
                 elif filter_type == "regex-not":
-                    if not re.search(filter, repo["repositoryName"]):
-                        repo_list_filtered.append(repo["repositoryName"])
-                else:
-                    repo_list_filtered.append(repo["repositoryName"])
-            if "nextToken" in repo_list:
-                next_token = repo_list["nextToken"]
-            else:
-                flag_run = False
+                    if pattern.search(name):
+                        continue
+                repo_count += 1
+                yield ECRRepo(
+                    repository_name=name,
+                    store=store,
+                    account=self.account,
+                    region=self.region,
+                )
 
         console.log(
-            f"ECR repositories founded (based on filter strategy): {len(repo_list_filtered)}"
+            f"ECR repositories founded (based on filter strategy): {repo_count}"
         )
-        return [ECRRepo(repository_name=repo) for repo in repo_list_filtered]
 
-    def list_images(self, repository_name):
-        client = self.__session.client("ecr")
+    def list_images(self, repository_name, selection=None):
+        if not selection:
+            return list(self.iter_images(repository_name))
+        if selection.tags_only:
+            return self.list_selected_ids(repository_name, selection)
+        return selection.apply(self.iter_images(repository_name))
+
+    def list_selected_ids(self, repository_name, selection):
+        """
+        Choose the digests by their tags on the ListImages pages and describe
+        only the selected images
+        """
+        image_ids = self.list_image_ids(repository_name, selection.select_tags)
+        candidates = selection.apply(
+            ECRImage(digest=digest, tags=tags, pushed_at=None, size_bytes=0)
+            for digest, tags in image_ids.items()
+        )
+        images = self.describe_image_ids(
+            repository_name, [image.digest for image in candidates]
+        )
+        for image in images:
+            image.image_tags = image_ids[image.digest]
+        # Keep the selection order, newest first
+        order = {image.digest: index for index, image in enumerate(candidates)}
+        return sorted(images, key=lambda image: order[image.digest])
+
+    def iter_images(self, repository_name):
+        client = self.client(describe=True)
         next_token = None
         flag_run = True
-        image_list = []
         # console.log(f"Describe images from ECR repository: {repository_name}")
         while flag_run:
             if not next_token:
-                img_list = client.describe_images(
-                    repositoryName=repository_name, filter={"tagStatus": "TAGGED"}
+                img_list = self.call(
+                    client.describe_images,
+                    repositoryName=repository_name,
+                    filter={"tagStatus": "TAGGED"},
                 )
             else:
-                img_list = client.describe_images(
+                img_list = self.call(
+                    client.describe_images,
                     repositoryName=repository_name,
                     filter={"tagStatus": "TAGGED"},
                     nextToken=next_token,
@@ -151,62 +316,1797 @@ class ECR:
                     pushed_at=image["imagePushedAt"],
                     size_bytes=image["imageSizeInBytes"],
                 )
-                image_list.append(img)
+                yield img
 
             if "nextToken" in img_list:
                 next_token = img_list["nextToken"]
             else:
-                flag_run = False
+                flag_run = False
+
+    def list_image_ids(self, repository_name, select_tags=None):
+        """
+        Return the tags of each tagged image digest using ListImages, which
+        is lighter than DescribeImages and returns up to 1000 images per page.
+        With select_tags, only the digests with selected tags are returned
+        """
+        client = self.client(describe=True)
+        next_token = None
+        flag_run = True
+        image_ids = {}
+        while flag_run:
+            params = {
+                "repositoryName": repository_name,
+                "filter": {"tagStatus": "TAGGED"},
+                "maxResults": 1000,
+            }
+            if next_token:
+                params["nextToken"] = next_token
+            id_list = self.call(client.list_images, **params)
+            for image_id in id_list["imageIds"]:
+                if select_tags:
+                    if "imageTag" in image_id and select_tags([image_id["imageTag"]]):
+                        image_ids.setdefault(image_id["imageDigest"], []).append(
+                            image_id["imageTag"]
+                        )
+                    continue
+                tags = image_ids.setdefault(image_id["imageDigest"], [])
+                if "imageTag" in image_id:
+                    tags.append(image_id["imageTag"])
+            if "nextToken" in id_list:
+                next_token = id_list["nextToken"]
+            else:
+                flag_run = False
+        return image_ids
+
+    def describe_image_ids(self, repository_name, digests):
+        client = self.client(describe=True)
+        image_list = []
+        for index in range(0, len(digests), 100):
+            img_list = self.call(
+                client.describe_images,
+                repositoryName=repository_name,
+                imageIds=[
+                    {"imageDigest": digest} for digest in digests[index : index + 100]
+                ],
+            )
+            for image in img_list["imageDetails"]:
+                image_list.append(
+                    ECRImage(
+                        digest=image["imageDigest"],
+                        tags=image["imageTags"] if "imageTags" in image else None,
+                        pushed_at=image["imagePushedAt"],
+                        size_bytes=image["imageSizeInBytes"],
+                    )
+                )
+        return image_list
+
+    def create_repository(self, repository_name):
+        client = self.client()
+        try:
+            client.create_repository(repositoryName=repository_name)
+            console.log(f"ECR repository created: {repository_name}")
+        except client.exceptions.RepositoryAlreadyExistsException:
+            pass
+
+    def get_manifest(self, repository_name, digest):
+        client = self.client()
+        response = client.batch_get_image(
+            repositoryName=repository_name,
+            imageIds=[{"imageDigest": digest}],
+            acceptedMediaTypes=MANIFEST_MEDIA_TYPES,
+        )
+        if not response["images"]:
+            failure = response["failures"][0] if response["failures"] else {}
+            raise LookupError(
+                f"Manifest {digest} not found on {repository_name}: "
+                f"{failure.get('failureReason', 'unknown reason')}"
+            )
+        image = response["images"][0]
+        return ECRManifest(
+            digest=digest,
+            manifest=image["imageManifest"],
+            media_type=image.get("imageManifestMediaType"),
+        )
+
+    def get_manifests(self, repository_name, digests):
+        """
+        Fetch many manifests with BatchGetImage, up to 100 per call
+        """
+        client = self.client(describe=True)
+        manifests = []
+        for index in range(0, len(digests), 100):
+            response = self.call(
+                client.batch_get_image,
+                repositoryName=repository_name,
+                imageIds=[
+                    {"imageDigest": digest} for digest in digests[index : index + 100]
+                ],
+                acceptedMediaTypes=MANIFEST_MEDIA_TYPES,
+            )
+            for image in response["images"]:
+                manifests.append(
+                    ECRManifest(
+                        digest=image["imageId"]["imageDigest"],
+                        manifest=image["imageManifest"],
+                        media_type=image.get("imageManifestMediaType"),
+                    )
+                )
+            for failure in response["failures"]:
+                console.log(
+                    f"[yellow]Manifest {failure['imageId'].get('imageDigest')} not found "
+                    f"on {repository_name}: {failure.get('failureReason')}[/yellow]"
+                )
+        return manifests
+
+    def put_image(self, repository_name, manifest, tag=None):
+        client = self.client()
+        params = {
+            "repositoryName": repository_name,
+            "imageManifest": manifest.manifest,
+            "imageDigest": manifest.digest,
+        }
+        if manifest.media_type:
+            params["imageManifestMediaType"] = manifest.media_type
+        if tag:
+            params["imageTag"] = tag
+        try:
+            response = client.put_image(**params)
+        except client.exceptions.ImageAlreadyExistsException:
+            return manifest.digest
+        return response["image"]["imageId"]["imageDigest"]
+
+    def check_layer_availability(self, repository_name, layer_digests):
+        client = self.client()
+        available = set()
+        for index in range(0, len(layer_digests), 100):
+            response = client.batch_check_layer_availability(
+                repositoryName=repository_name,
+                layerDigests=layer_digests[index : index + 100],
+            )
+            for layer in response["layers"]:
+                if layer.get("layerAvailability") == "AVAILABLE":
+                    available.add(layer["layerDigest"])
+        return available
+
+    def open_layer(self, repository_name, layer_digest, first_byte=0):
+        client = self.client()
+        response = client.get_download_url_for_layer(
+            repositoryName=repository_name, layerDigest=layer_digest
+        )
+        headers = {"Range": f"bytes={first_byte}-"} if first_byte else None
+        blob = self.__http.request(
+            "GET", response["downloadUrl"], headers=headers, preload_content=False
+        )
+        if blob.status != (206 if first_byte else 200):
+            blob.release_conn()
+            raise IOError(
+                f"Layer {layer_digest} download failed with HTTP status {blob.status}"
+            )
+        return blob
+
+    def upload_layer(
+        self,
+        repository_name,
+        layer_digest,
+        stream,
+        buffer,
+        upload=None,
+        on_part=None,
+        bandwidth=None,
+    ):
+        """
+        Upload the layer read from stream using buffer as part storage
+
+        To resume an upload, inform upload as (upload id, first byte) with the
+        stream already positioned on that byte. The local digest check is only
+        possible for complete uploads, resumed ones rely on the ECR validation
+        """
+        client = self.client()
+        if upload:
+            upload_id, first_byte = upload
+            digest = None
+        else:
+            upload_id = client.initiate_layer_upload(repositoryName=repository_name)[
+                "uploadId"
+            ]
+            first_byte = 0
+            digest = hashlib.sha256()
+        view = memoryview(buffer)
+        try:
+            while True:
+                size = read_chunk(stream, view)
+                if not size:
+                    break
+                if self.metrics:
+                    self.metrics.add_bytes("LayerDownload", size)
+                if digest:
+                    digest.update(view[:size])
+                if bandwidth:
+                    bandwidth.consume(size)
+                client.upload_layer_part(
+                    repositoryName=repository_name,
+                    uploadId=upload_id,
+                    partFirstByte=first_byte,
+                    partLastByte=first_byte + size - 1,
+                    layerPartBlob=(
+                        buffer if size == len(buffer) else view[:size].tobytes()
+                    ),
+                )
+                first_byte += size
+                if on_part:
+                    on_part(upload_id, first_byte)
+        finally:
+            stream.release_conn()
+        if digest and f"sha256:{digest.hexdigest()}" != layer_digest:
+            raise ValueError(
+                f"Layer {layer_digest} content doesn't match its digest "
+                f"(sha256:{digest.hexdigest()})"
+            )
+        try:
+            client.complete_layer_upload(
+                repositoryName=repository_name,
+                uploadId=upload_id,
+                layerDigests=[layer_digest],
+            )
+        except client.exceptions.LayerAlreadyExistsException:
+            pass
+        return first_byte
+
+
+def read_chunk(stream, view):
+    size = 0
+    while size < len(view):
+        read = stream.readinto(view[size:])
+        if not read:
+            break
+        size += read
+    return size
+
+
+class BufferPool:
+
+    def __init__(self, chunk_size, max_in_flight):
+        self.chunk_size = chunk_size
+        self.size = max(1, max_in_flight // chunk_size)
+        self.__buffers = queue.LifoQueue()
+        self.__created = 0
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def acquire(self):
+        buffer = None
+        with self.__lock:
+            if self.__buffers.empty() and self.__created < self.size:
+                self.__created += 1
+                buffer = bytearray(self.chunk_size)
+        if buffer is None:
+            buffer = self.__buffers.get()
+        try:
+            yield buffer
+        finally:
+            self.__buffers.put(buffer)
+
+
+class ECRRepo:
+
+    def __init__(self, repository_name, store=None, account=None, region=None):
+        self.repository_name = repository_name
+        self.account = account
+        self.region = region
+        self.store = store if store is not None else ImageStore()
+        # Repository already migrated on journal, only its totals are known
+        self.migrated = False
+        # Size of the distinct layers of all images, when accounted
+        self.unique_bytes = None
+
+    @property
+    def images(self):
+        return self.store.images(self.repository_name)
+
+    def add_images(self, images):
+        self.store.add(self.repository_name, images)
+
+    def image_count(self):
+        return self.store.count(self.repository_name)
+
+    def size_bytes(self):
+        return self.store.size_bytes(self.repository_name)
+
+
+class ECRImage:
+    __slots__ = ("digest", "image_tags", "pushed_at", "size_bytes")
+
+    def __init__(self, digest, tags, pushed_at, size_bytes):
+        self.digest = digest
+        self.image_tags = tags
+        self.pushed_at = pushed_at
+        self.size_bytes = size_bytes
+
+    @property
+    def size_readable(self):
+        return readable_size(self.size_bytes)
+
+
+SEMVER_REGEX = re.compile(
+    r"^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$"
+)
+
+
+def semver_key(tag):
+    """
+    Sort key of a semantic version tag, None when the tag isn't a version.
+    Pre-releases sort before their release and numeric identifiers before
+    alphanumeric ones, as defined by semver.org
+    """
+    match = SEMVER_REGEX.match(tag)
+    if not match:
+        return None
+    major, minor, patch, prerelease = match.groups()
+    if prerelease is None:
+        release = (1,)
+    else:
+        release = (0,) + tuple(
+            (0, int(part), "") if part.isdigit() else (1, 0, part)
+            for part in prerelease.split(".")
+        )
+    return (int(major), int(minor), int(patch), release)
+
+
+class ImageSelection:
+    """
+    Rules to choose the images of each repository: tag regex, pushed after a
+    date and the newest N by push date or by semantic version tag.
+    Images are filtered as the pages arrive and only the N newest are kept
+    on a heap, so the excluded images are never stored or migrated
+    """
+
+    def __init__(self, tag_regex=None, pushed_after=None, newest=None, order="pushed"):
+        self.tag_regex = re.compile(tag_regex) if tag_regex else None
+        self.pushed_after = pushed_after
+        self.newest = newest
+        self.order = order
+
+    def __bool__(self):
+        return bool(self.tag_regex or self.pushed_after or self.newest)
+
+    @property
+    def tags_only(self):
+        """
+        The rules only need the tags, so ListImages can choose the digests
+        and DescribeImages is called only for the selected ones
+        """
+        if self.pushed_after:
+            return False
+        if self.newest:
+            return self.order == "semver"
+        return bool(self.tag_regex)
+
+    def select_tags(self, tags):
+        if not self.tag_regex:
+            return tags
+        return [tag for tag in tags or [] if self.tag_regex.search(tag)]
+
+    def key(self, image):
+        if self.order == "semver":
+            versions = [
+                version
+                for version in map(semver_key, image.image_tags or [])
+                if version
+            ]
+            # Images without a version tag are the oldest ones
+            return (1, max(versions)) if versions else (0,)
+        return image.pushed_at
+
+    def match(self, image):
+        if self.tag_regex:
+            image.image_tags = self.select_tags(image.image_tags)
+            if not image.image_tags:
+                return False
+        if self.pushed_after and image.pushed_at < self.pushed_after:
+            return False
+        return True
+
+    def apply(self, images):
+        if not self.newest:
+            return [image for image in images if self.match(image)]
+        newest = []
+        for sequence, image in enumerate(images):
+            if not self.match(image):
+                continue
+            item = (self.key(image), sequence, image)
+            if len(newest) < self.newest:
+                heapq.heappush(newest, item)
+            elif item[0] > newest[0][0]:
+                heapq.heapreplace(newest, item)
+        return [item[2] for item in sorted(newest, reverse=True)]
+
+
+class ImageStore:
+    """
+    Images of many repositories stored by columns: digests and tags are
+    interned, sizes and push dates live on numeric arrays and the quantity and
+    size per repository and in total are updated as images are added.
+    ECRImage objects are only created when the images of a repository are read.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__digests = []
+        self.__tags = []
+        self.__pushed_at = array.array("d")
+        self.__sizes = array.array("q")
+        self.__rows = {}
+        self.__totals = {}
+        self.total_count = 0
+        self.total_size = 0
+
+    def add(self, repository_name, images):
+        with self.__lock:
+            rows = self.__rows.setdefault(repository_name, array.array("q"))
+            totals = self.__totals.setdefault(repository_name, [0, 0])
+            for image in images:
+                rows.append(len(self.__digests))
+                self.__digests.append(sys.intern(image.digest))
+                self.__tags.append(
+                    tuple(sys.intern(tag) for tag in image.image_tags)
+                    if image.image_tags
+                    else None
+                )
+                self.__pushed_at.append(image.pushed_at.timestamp())
+                self.__sizes.append(image.size_bytes)
+                totals[0] += 1
+                totals[1] += image.size_bytes
+                self.total_count += 1
+                self.total_size += image.size_bytes
+
+    def add_summary(self, repository_name, image_count, size_bytes):
+        with self.__lock:
+            totals = self.__totals.setdefault(repository_name, [0, 0])
+            totals[0] += image_count
+            totals[1] += size_bytes
+            self.total_count += image_count
+            self.total_size += size_bytes
+
+    def count(self, repository_name):
+        return self.__totals.get(repository_name, [0, 0])[0]
+
+    def size_bytes(self, repository_name):
+        return self.__totals.get(repository_name, [0, 0])[1]
+
+    def images(self, repository_name):
+        with self.__lock:
+            rows = list(self.__rows.get(repository_name, []))
+        return [
+            ECRImage(
+                digest=self.__digests[row],
+                tags=list(self.__tags[row]) if self.__tags[row] else None,
+                pushed_at=datetime.datetime.fromtimestamp(
+                    self.__pushed_at[row], tz=datetime.timezone.utc
+                ),
+                size_bytes=self.__sizes[row],
+            )
+            for row in rows
+        ]
+
+
+class ECRManifest:
+
+    def __init__(self, digest, manifest, media_type=None):
+        self.digest = digest
+        self.manifest = manifest
+        content = json.loads(manifest)
+        self.media_type = media_type or content.get("mediaType")
+        self.content = content
+
+    def is_index(self):
+        return self.media_type in MANIFEST_INDEX_MEDIA_TYPES
+
+    def child_digests(self):
+        if not self.is_index():
+            return []
+        return [child["digest"] for child in self.content.get("manifests", [])]
+
+    def layer_digests(self):
+        if self.is_index():
+            return []
+        if "fsLayers" in self.content:
+            # Schema 1 manifests repeat the same blob for empty layers
+            layers = [layer["blobSum"] for layer in self.content["fsLayers"]]
+            return list(dict.fromkeys(layers))
+        layers = []
+        if "config" in self.content:
+            layers.append(self.content["config"]["digest"])
+        for layer in self.content.get("layers", []):
+            if layer.get("mediaType") in FOREIGN_LAYER_MEDIA_TYPES:
+                continue
+            layers.append(layer["digest"])
+        return list(dict.fromkeys(layers))
+
+    def layer_sizes(self):
+        if self.is_index() or "fsLayers" in self.content:
+            # Schema 1 manifests don't inform the layers size
+            return {}
+        layers = [self.content["config"]] if "config" in self.content else []
+        layers.extend(self.content.get("layers", []))
+        return {
+            layer["digest"]: layer.get("size", 0)
+            for layer in layers
+            if layer.get("mediaType") not in FOREIGN_LAYER_MEDIA_TYPES
+        }
+
+
+class ManifestCache:
+    """
+    Manifests stored on disk by digest. A digest is the hash of the manifest
+    content, so a cached manifest never gets stale
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __file(self, digest):
+        return os.path.join(self.path, digest.replace(":", "-") + ".json")
+
+    def get(self, digest):
+        try:
+            with open(self.__file(digest), "r", encoding="utf-8") as manifest_file:
+                content = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+        return ECRManifest(
+            digest=digest,
+            manifest=content["manifest"],
+            media_type=content["media_type"],
+        )
+
+    def put(self, manifest):
+        atomic_write(
+            self.__file(manifest.digest),
+            json.dumps(
+                {"manifest": manifest.manifest, "media_type": manifest.media_type}
+            ),
+        )
+
+
+class LayerAccounting:
+    """
+    Unique layer bytes per repository and in total, from the image manifests,
+    so layers shared by tags and repositories are counted only once
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.__lock = threading.Lock()
+        self.__layers = set()
+        self.total_bytes = 0
+        self.fetched = 0
+
+    def manifests(self, ecr, repository_name, digests):
+        manifests = []
+        # Every digest asked once: the failed ones are only logged by get_manifests
+        requested = set()
+        digests = list(dict.fromkeys(digests))
+        while digests:
+            missing = []
+            requested.update(digests)
+            for digest in digests:
+                manifest = self.cache.get(digest)
+                if manifest:
+                    manifests.append(manifest)
+                else:
+                    missing.append(digest)
+            fetched = ecr.get_manifests(repository_name, missing) if missing else []
+            for manifest in fetched:
+                self.cache.put(manifest)
+            with self.__lock:
+                self.fetched += len(fetched)
+            manifests.extend(fetched)
+            # Manifest lists and indexes only point to other manifests
+            digests = list(
+                dict.fromkeys(
+                    child
+                    for manifest in manifests
+                    for child in manifest.child_digests()
+                    if child not in requested
+                )
+            )
+        return manifests
+
+    def account(self, ecr, repository_name, images):
+        layers = {}
+        for manifest in self.manifests(
+            ecr, repository_name, [image.digest for image in images]
+        ):
+            layers.update(manifest.layer_sizes())
+        with self.__lock:
+            for digest, size in layers.items():
+                if digest not in self.__layers:
+                    self.__layers.add(digest)
+                    self.total_bytes += size
+        return sum(layers.values())
+
+
+class ECRMigration:
+
+    def __init__(
+        self,
+        source,
+        destination,
+        buffers,
+        journal=None,
+        bandwidth=None,
+        on_bytes=None,
+    ):
+        self.source = source
+        self.destination = destination
+        self.buffers = buffers
+        self.journal = journal
+        self.bandwidth = bandwidth
+        self.on_bytes = on_bytes
+        self.images_done = 0
+        self.__thread = threading.local()
+        self.__lock = threading.Lock()
+        self.__repositories = set()
+        self.__available_layers = set(journal.done_layers()) if journal else set()
+        self.__layer_locks = {}
+
+    def ensure_repository(self, repository_name):
+        with self.__lock:
+            if repository_name in self.__repositories:
+                return
+            self.__repositories.add(repository_name)
+        self.destination.create_repository(repository_name)
+
+    def copy_image(self, repository_name, image):
+        self.__thread.reported_bytes = 0
+        self.ensure_repository(repository_name)
+        result = MigrationResult(repository_name, image.digest, 0, 0, 0)
+        manifest = self.source.get_manifest(repository_name, image.digest)
+        result = self.copy_manifest(repository_name, manifest, result)
+        for tag in image.image_tags or [None]:
+            digest = self.destination.put_image(repository_name, manifest, tag=tag)
+            if digest != image.digest:
+                raise ValueError(
+                    f"Destiny digest {digest} doesn't match origin {image.digest}"
+                )
+        if self.journal:
+            self.journal.mark_image(repository_name, image.digest, "verified")
+        with self.__lock:
+            self.images_done += 1
+        return result
+
+    def report_bytes(self, size):
+        self.__thread.reported_bytes = self.reported_bytes() + size
+        if self.on_bytes:
+            self.on_bytes(size)
+
+    def reported_bytes(self):
+        """
+        Layer bytes uploaded by the current thread for the image being copied
+        """
+        return getattr(self.__thread, "reported_bytes", 0)
+
+    def copy_manifest(self, repository_name, manifest, result):
+        for child_digest in manifest.child_digests():
+            child = self.source.get_manifest(repository_name, child_digest)
+            result = self.copy_manifest(repository_name, child, result)
+
+        layers = manifest.layer_digests()
+        with self.__lock:
+            pending = [
+                layer
+                for layer in layers
+                if (repository_name, layer) not in self.__available_layers
+            ]
+        if pending:
+            available = self.destination.check_layer_availability(
+                repository_name, pending
+            )
+            with self.__lock:
+                self.__available_layers.update(
+                    (repository_name, layer) for layer in available
+                )
+            pending = [layer for layer in pending if layer not in available]
+
+        copied_bytes = 0
+        copied_layers = 0
+        for layer in pending:
+            size = self.copy_layer(repository_name, layer)
+            if size is not None:
+                copied_layers += 1
+                copied_bytes += size
+        result = result._replace(
+            layers_copied=result.layers_copied + copied_layers,
+            layers_skipped=result.layers_skipped + len(layers) - copied_layers,
+            bytes_copied=result.bytes_copied + copied_bytes,
+        )
+
+        if manifest.digest != result.digest:
+            self.destination.put_image(repository_name, manifest)
+        return result
+
+    def copy_layer(self, repository_name, layer_digest):
+        key = (repository_name, layer_digest)
+        # Lock and number of threads using it, removed by the last one (even
+        # when the transfer fails), so the dict doesn't grow on long runs
+        with self.__lock:
+            layer_lock = self.__layer_locks.setdefault(key, [threading.Lock(), 0])
+            layer_lock[1] += 1
+        try:
+            with layer_lock[0]:
+                with self.__lock:
+                    if key in self.__available_layers:
+                        return None
+                with self.buffers.acquire() as buffer:
+                    size = self.transfer_layer(repository_name, layer_digest, buffer)
+                if self.journal:
+                    self.journal.mark_layer(repository_name, layer_digest, "done")
+                with self.__lock:
+                    self.__available_layers.add(key)
+                return size
+        finally:
+            with self.__lock:
+                layer_lock[1] -= 1
+                if not layer_lock[1]:
+                    del self.__layer_locks[key]
+
+    def transfer_layer(self, repository_name, layer_digest, buffer):
+        upload = None
+        if self.journal:
+            upload = self.journal.get_upload(repository_name, layer_digest)
+        uploaded = [upload[1] if upload else 0]
+
+        def on_part(upload_id, uploaded_bytes):
+            if self.journal:
+                self.journal.save_upload(
+                    repository_name, layer_digest, upload_id, uploaded_bytes
+                )
+            self.report_bytes(uploaded_bytes - uploaded[0])
+            uploaded[0] = uploaded_bytes
+
+        if upload:
+            console.log(
+                f"Resuming upload of {repository_name}@{layer_digest} from byte {upload[1]}"
+            )
+            try:
+                return self.destination.upload_layer(
+                    repository_name,
+                    layer_digest,
+                    self.source.open_layer(
+                        repository_name, layer_digest, first_byte=upload[1]
+                    ),
+                    buffer,
+                    upload=upload,
+                    on_part=on_part,
+                    bandwidth=self.bandwidth,
+                )
+            except (botocore_exceptions.ClientError, IOError) as exc:
+                if isinstance(exc, botocore_exceptions.ClientError) and exc.response[
+                    "Error"
+                ]["Code"] not in [
+                    "UploadNotFoundException",
+                    "InvalidLayerPartException",
+                ]:
+                    raise
+                console.log(
+                    f"Upload of {repository_name}@{layer_digest} can't be resumed, restarting it"
+                )
+                uploaded[0] = 0
+        return self.destination.upload_layer(
+            repository_name,
+            layer_digest,
+            self.source.open_layer(repository_name, layer_digest),
+            buffer,
+            on_part=on_part,
+            bandwidth=self.bandwidth,
+        )
+
+
+class BandwidthLimiter:
+    """
+    Global bytes per second budget: each part reserves its transmission slot
+    and waits until it starts, so all threads together stay under the rate
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.__lock = threading.Lock()
+        self.__next_slot = time.monotonic()
+
+    def consume(self, size):
+        with self.__lock:
+            now = time.monotonic()
+            start = max(now, self.__next_slot)
+            self.__next_slot = start + size / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class Journal:
+    """
+    Migration progress stored on SQLite, so an interrupted migration
+    executed again with the same arguments resumes where it stopped
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        with self.__lock:
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.executescript("""
+                CREATE TABLE IF NOT EXISTS repositories (
+                    repository_name TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    image_count INTEGER,
+                    size_bytes INTEGER,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS images (
+                    repository_name TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (repository_name, digest)
+                );
+                CREATE TABLE IF NOT EXISTS layers (
+                    repository_name TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    upload_id TEXT,
+                    uploaded_bytes INTEGER,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (repository_name, digest)
+                );
+                """)
+
+    def __execute(self, statement, parameters=()):
+        with self.__lock:
+            return self.__connection.execute(statement, parameters).fetchall()
+
+    def get_repository(self, repository_name):
+        rows = self.__execute(
+            "SELECT image_count, size_bytes FROM repositories "
+            "WHERE repository_name = ? AND status = 'done'",
+            (repository_name,),
+        )
+        return rows[0] if rows else None
+
+    def mark_repository(self, repository_name, status, image_count, size_bytes):
+        self.__execute(
+            "INSERT OR REPLACE INTO repositories VALUES (?, ?, ?, ?, ?)",
+            (repository_name, status, image_count, size_bytes, time.time()),
+        )
+
+    def verified_images(self, repository_name):
+        rows = self.__execute(
+            "SELECT digest FROM images WHERE repository_name = ? AND status = 'verified'",
+            (repository_name,),
+        )
+        return {row[0] for row in rows}
+
+    def mark_image(self, repository_name, digest, status):
+        self.__execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+            (repository_name, digest, status, time.time()),
+        )
+
+    def done_layers(self):
+        return self.__execute(
+            "SELECT repository_name, digest FROM layers WHERE status = 'done'"
+        )
+
+    def mark_layer(self, repository_name, digest, status):
+        self.__execute(
+            "INSERT OR REPLACE INTO layers VALUES (?, ?, ?, NULL, NULL, ?)",
+            (repository_name, digest, status, time.time()),
+        )
+
+    def get_upload(self, repository_name, digest):
+        rows = self.__execute(
+            "SELECT upload_id, uploaded_bytes FROM layers "
+            "WHERE repository_name = ? AND digest = ? AND status = 'uploading'",
+            (repository_name, digest),
+        )
+        return tuple(rows[0]) if rows else None
+
+    def save_upload(self, repository_name, digest, upload_id, uploaded_bytes):
+        self.__execute(
+            "INSERT OR REPLACE INTO layers VALUES (?, ?, 'uploading', ?, ?, ?)",
+            (repository_name, digest, upload_id, uploaded_bytes, time.time()),
+        )
+
+
+class WorkQueue:
+    """
+    Repositories to migrate stored on SQLite and claimed by worker processes,
+    on this host or on hosts sharing the file. A claim is a lease renewed while
+    the repository is migrated, so the repositories of a crashed worker are
+    claimed again when its lease expires
+    """
+
+    def __init__(self, path, lease=300, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.__lock = threading.Lock()
+        # Rollback journal instead of WAL, which doesn't work on shared filesystems
+        self.__connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=60
+        )
+        with self.__lock:
+            self.__connection.executescript("""
+                CREATE TABLE IF NOT EXISTS queue (
+                    repository_name TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    owner TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    image_count INTEGER,
+                    size_bytes INTEGER,
+                    updated_at REAL NOT NULL
+                );
+                """)
+
+    def __execute(self, statement, parameters=()):
+        with self.__lock:
+            return self.__connection.execute(statement, parameters).fetchall()
+
+    def add(self, repository_names):
+        """
+        Enqueue the repositories not yet known, so enqueuing again doesn't
+        reset the repositories already migrated
+        """
+        added = 0
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                for repository_name in repository_names:
+                    added += self.__connection.execute(
+                        "INSERT OR IGNORE INTO queue "
+                        "(repository_name, status, updated_at) VALUES (?, 'pending', ?)",
+                        (repository_name, time.time()),
+                    ).rowcount
+                self.__connection.execute("COMMIT")
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                raise
+        return added
+
+    def claim(self, owner):
+        now = time.time()
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.__connection.execute(
+                    "SELECT repository_name FROM queue WHERE status = 'pending' "
+                    "OR (status = 'leased' AND lease_until < ?) "
+                    "ORDER BY attempts, repository_name LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row:
+                    self.__connection.execute(
+                        "UPDATE queue SET status = 'leased', owner = ?, "
+                        "lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                        "WHERE repository_name = ?",
+                        (owner, now + self.lease, now, row[0]),
+                    )
+                self.__connection.execute("COMMIT")
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                raise
+        return row[0] if row else None
+
+    def renew(self, owner):
+        now = time.time()
+        self.__execute(
+            "UPDATE queue SET lease_until = ?, updated_at = ? "
+            "WHERE owner = ? AND status = 'leased'",
+            (now + self.lease, now, owner),
+        )
+
+    def finish(
+        self, repository_name, owner, success, image_count=None, size_bytes=None
+    ):
+        """
+        Release the repository with its final status, or "lost" when the lease
+        expired and another worker claimed it (its result is the one that counts)
+        """
+        if success:
+            status = "done"
+        else:
+            rows = self.__execute(
+                "SELECT attempts FROM queue WHERE repository_name = ?",
+                (repository_name,),
+            )
+            status = "failed" if rows[0][0] >= self.max_attempts else "pending"
+        with self.__lock:
+            updated = self.__connection.execute(
+                "UPDATE queue SET status = ?, owner = NULL, lease_until = NULL, "
+                "image_count = ?, size_bytes = ?, updated_at = ? "
+                "WHERE repository_name = ? AND owner = ?",
+                (status, image_count, size_bytes, time.time(), repository_name, owner),
+            ).rowcount
+        return status if updated else "lost"
+
+    def remaining(self):
+        return self.__execute(
+            "SELECT COUNT(*) FROM queue WHERE status IN ('pending', 'leased')"
+        )[0][0]
+
+    def counts(self):
+        return dict(
+            self.__execute("SELECT status, COUNT(*) FROM queue GROUP BY status")
+        )
+
+
+class Inventory:
+    """
+    Repositories images snapshot stored on a JSON file
+
+    A repository already on the snapshot is refreshed with ListImages only and
+    just the new digests are described. Repositories not fully described for
+    more than max_age seconds are described again from scratch.
+    """
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        self.__lock = threading.Lock()
+        self.__repositories = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as inventory_file:
+                self.__repositories = json.load(inventory_file)["repositories"]
+
+    def refresh(self, ecr, repository_name):
+        with self.__lock:
+            cached = self.__repositories.get(repository_name)
+        now = time.time()
+        if not cached or now - cached["scanned_at"] > self.max_age:
+            images = ecr.list_images(repository_name)
+            self.__store(repository_name, images, now)
+            return images
+
+        cached_images = {
+            image[0]: ECRImage(
+                digest=image[0],
+                tags=image[1],
+                pushed_at=datetime.datetime.fromisoformat(image[2]),
+                size_bytes=image[3],
+            )
+            for image in cached["images"]
+        }
+        image_ids = ecr.list_image_ids(repository_name)
+        new_digests = [digest for digest in image_ids if digest not in cached_images]
+        changed = len(image_ids) != len(cached_images) or new_digests
+        images = ecr.describe_image_ids(repository_name, new_digests)
+        for digest, tags in image_ids.items():
+            if digest in cached_images:
+                image = cached_images[digest]
+                if sorted(image.image_tags or []) != sorted(tags):
+                    image.image_tags = tags
+                    changed = True
+                images.append(image)
+        if changed:
+            self.__store(repository_name, images, cached["scanned_at"])
+        return images
+
+    def __store(self, repository_name, images, scanned_at):
+        with self.__lock:
+            self.__repositories[repository_name] = {
+                "scanned_at": scanned_at,
+                "images": [
+                    [
+                        image.digest,
+                        image.image_tags,
+                        image.pushed_at.isoformat(),
+                        image.size_bytes,
+                    ]
+                    for image in images
+                ],
+            }
+
+    def save(self):
+        with self.__lock:
+            content = json.dumps(
+                {"saved_at": time.time(), "repositories": self.__repositories}
+            )
+        atomic_write(self.path, content)
+        console.log(f"Inventory saved: {self.path}")
+
+
+def journal_path(*arguments):
+    key = hashlib.sha1(json.dumps(arguments).encode("utf-8")).hexdigest()[:12]
+    return f"ecr-migration-{key}.sqlite"
+
+
+MigrationResult = namedtuple(
+    "MigrationResult",
+    ["repository_name", "digest", "layers_copied", "layers_skipped", "bytes_copied"],
+)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit: grows by one slot per window of calls while the
+    latency stays close to the observed baseline and halves on throttling
+    """
+
+    def __init__(self, maximum, minimum=1, initial=10):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.__active = 0
+        self.__baseline = None
+        self.__last_decrease = 0.0
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while self.__active >= int(self.limit):
+                self.__condition.wait()
+            self.__active += 1
+
+    def release(self):
+        with self.__condition:
+            self.__active -= 1
+            self.__condition.notify()
+
+    def on_success(self, latency):
+        with self.__condition:
+            if self.__baseline is None:
+                self.__baseline = latency
+            if latency <= self.__baseline * 2:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.__condition.notify_all()
+            self.__baseline = self.__baseline * 0.95 + latency * 0.05
+
+    def on_throttle(self):
+        with self.__condition:
+            now = time.monotonic()
+            # One decrease per second, a burst of throttles is a single signal
+            if now - self.__last_decrease < 1.0:
+                return
+            self.__last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+            console.log(
+                f"[yellow]ECR throttling, concurrency reduced to {int(self.limit)}[/yellow]"
+            )
+
+
+class Metrics:
+    """
+    Per operation calls, latency histogram, errors, retries, throttles and
+    bytes, collected from the botocore client events, plus the time items
+    wait on the Worker queues before a thread starts them
+    """
+
+    BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__operations = {}
+        self.__queues = {}
+        self.__stop = threading.Event()
+        self.__writer = None
+        self.started = time.monotonic()
+        self.cpu_started = time.process_time()
+
+    def register(self, client):
+        client.meta.events.register("before-call.ecr", self.before_call)
+        client.meta.events.register("after-call.ecr", self.after_call)
+        client.meta.events.register("after-call-error.ecr", self.after_call_error)
+
+    def before_call(self, model, params, context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+        # after-call-error doesn't receive the model, only the context
+        context["metrics_operation"] = model.name
+        if "layerPartBlob" in params:
+            context["metrics_bytes"] = len(params["layerPartBlob"])
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        context.pop("metrics_operation", None)
+        self.observe(
+            model.name,
+            time.perf_counter() - context.pop("metrics_started", time.perf_counter()),
+            error=parsed.get("Error", {}).get("Code"),
+            retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            size=context.pop("metrics_bytes", 0),
+        )
+
+    def after_call_error(self, exception, context, **kwargs):
+        self.observe(
+            context.pop("metrics_operation", "Unknown"),
+            time.perf_counter() - context.pop("metrics_started", time.perf_counter()),
+            error=type(exception).__name__,
+        )
+
+    def __operation(self, name):
+        operation = self.__operations.get(name)
+        if operation is None:
+            operation = self.__operations[name] = {
+                "calls": 0,
+                "errors": 0,
+                "throttles": 0,
+                "retries": 0,
+                "bytes": 0,
+                "latency_sum": 0.0,
+                "latency_buckets": [0] * (len(self.BUCKETS) + 1),
+            }
+        return operation
+
+    def observe(self, name, latency, error=None, retries=0, size=0):
+        bucket = bisect.bisect_left(self.BUCKETS, latency)
+        with self.__lock:
+            operation = self.__operation(name)
+            operation["calls"] += 1
+            operation["retries"] += retries
+            operation["bytes"] += size
+            operation["latency_sum"] += latency
+            operation["latency_buckets"][bucket] += 1
+            if error:
+                operation["errors"] += 1
+                if error in THROTTLING_ERRORS:
+                    operation["throttles"] += 1
+
+    def add_retry(self, name):
+        with self.__lock:
+            self.__operation(name)["retries"] += 1
+
+    def add_bytes(self, name, size):
+        with self.__lock:
+            self.__operation(name)["bytes"] += size
+
+    def observe_wait(self, name, wait):
+        with self.__lock:
+            queue_wait = self.__queues.setdefault(
+                name, {"items": 0, "wait_sum": 0.0, "wait_max": 0.0}
+            )
+            queue_wait["items"] += 1
+            queue_wait["wait_sum"] += wait
+            queue_wait["wait_max"] = max(queue_wait["wait_max"], wait)
+
+    def percentile(self, buckets, share):
+        target = sum(buckets) * share
+        accumulated = 0
+        for index, count in enumerate(buckets):
+            accumulated += count
+            if count and accumulated >= target:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else None
+        return None
+
+    def summary(self):
+        with self.__lock:
+            operations = {
+                name: dict(
+                    operation, latency_buckets=list(operation["latency_buckets"])
+                )
+                for name, operation in self.__operations.items()
+            }
+            queues = {name: dict(wait) for name, wait in self.__queues.items()}
+        for operation in operations.values():
+            calls = sum(operation["latency_buckets"])
+            operation["latency_avg"] = (
+                operation["latency_sum"] / calls if calls else None
+            )
+            # Upper bound of the histogram bucket, None when above the last one
+            operation["latency_p50"] = self.percentile(
+                operation["latency_buckets"], 0.5
+            )
+            operation["latency_p95"] = self.percentile(
+                operation["latency_buckets"], 0.95
+            )
+            operation["latency_buckets"] = dict(
+                zip(
+                    [str(bucket) for bucket in self.BUCKETS] + ["+Inf"],
+                    operation["latency_buckets"],
+                )
+            )
+        for queue_wait in queues.values():
+            queue_wait["wait_avg"] = queue_wait["wait_sum"] / queue_wait["items"]
+        return {
+            "wall_seconds": time.monotonic() - self.started,
+            "cpu_seconds": time.process_time() - self.cpu_started,
+            "operations": operations,
+            "queues": queues,
+        }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = []
+        counters = [
+            ("calls", "ECR API calls"),
+            ("errors", "ECR API calls returning errors"),
+            ("throttles", "ECR API calls throttled"),
+            ("retries", "ECR API retries made by botocore and by ECR.call"),
+            ("bytes", "Layer bytes sent or received"),
+        ]
+        for field, description in counters:
+            lines.append(f"# HELP ecr_api_{field}_total {description}")
+            lines.append(f"# TYPE ecr_api_{field}_total counter")
+            for name, operation in summary["operations"].items():
+                lines.append(
+                    f'ecr_api_{field}_total{{operation="{name}"}} {operation[field]}'
+                )
+        lines.append("# HELP ecr_api_latency_seconds ECR API call latency")
+        lines.append("# TYPE ecr_api_latency_seconds histogram")
+        for name, operation in summary["operations"].items():
+            accumulated = 0
+            for bucket, count in operation["latency_buckets"].items():
+                accumulated += count
+                lines.append(
+                    f'ecr_api_latency_seconds_bucket{{operation="{name}",le="{bucket}"}} {accumulated}'
+                )
+            lines.append(
+                f'ecr_api_latency_seconds_sum{{operation="{name}"}} {operation["latency_sum"]}'
+            )
+            lines.append(
+                f'ecr_api_latency_seconds_count{{operation="{name}"}} {accumulated}'
+            )
+        lines.append("# HELP worker_queue_wait_seconds Time items wait for a thread")
+        lines.append("# TYPE worker_queue_wait_seconds summary")
+        for name, queue_wait in summary["queues"].items():
+            lines.append(
+                f'worker_queue_wait_seconds_sum{{worker="{name}"}} {queue_wait["wait_sum"]}'
+            )
+            lines.append(
+                f'worker_queue_wait_seconds_count{{worker="{name}"}} {queue_wait["items"]}'
+            )
+        lines.append("# TYPE migrate_ecr_cpu_seconds_total counter")
+        lines.append(f"migrate_ecr_cpu_seconds_total {summary['cpu_seconds']}")
+        lines.append("# TYPE migrate_ecr_wall_seconds gauge")
+        lines.append(f"migrate_ecr_wall_seconds {summary['wall_seconds']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, content):
+        atomic_write(path, content)
+
+    def start_prometheus(self, path, interval):
+        def write_periodically():
+            while not self.__stop.wait(interval):
+                self.write(path, self.prometheus())
+
+        self.__writer = threading.Thread(target=write_periodically, daemon=True)
+        self.__writer.start()
+
+    def stop(self, json_path=None, prometheus_path=None):
+        self.__stop.set()
+        if self.__writer:
+            self.__writer.join()
+        if prometheus_path:
+            self.write(prometheus_path, self.prometheus())
+        if json_path:
+            self.write(json_path, json.dumps(self.summary(), indent=2))
+            console.log(f"Metrics saved: {json_path}")
+
+
+class Worker:
+
+    def __init__(self, concurrent_threads, concurrency=None, metrics=None, name=None):
+        self.concurrent_threads = concurrent_threads
+        self.concurrency = concurrency
+        self.metrics = metrics
+        self.name = name
+
+    def run(self, target, content):
+        """
+        Process content, a list or a generator, keeping at most two items per
+        thread queued: a generator is consumed only as the threads get free
+        """
+        if self.concurrency:
+            target = self.limited(target)
+        if self.metrics:
+            target = self.timed(target, self.name or target.__name__)
+        results = []
+        max_pending = self.concurrent_threads * 2
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrent_threads
+        ) as executor:
+            pending = set()
+            for cont in content:
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    results.extend(future.result() for future in done)
+                if self.metrics:
+                    cont = (time.monotonic(), cont)
+                pending.add(executor.submit(target, cont))
+            for future in concurrent.futures.as_completed(pending):
+                results.append(future.result())
+            return results
+
+    def limited(self, target):
+        def run_limited(content):
+            self.concurrency.acquire()
+            try:
+                return target(content)
+            finally:
+                self.concurrency.release()
+
+        return run_limited
+
+    def timed(self, target, name):
+        def run_timed(content):
+            submitted, content = content
+            self.metrics.observe_wait(name, time.monotonic() - submitted)
+            return target(content)
+
+        return run_timed
+
+
+class TableReport:
+
+    def __init__(self, scope=False, unique_layers=False):
+        self.scope = scope
+        self.unique_layers = unique_layers
+        self.table = rich_table.Table(
+            show_header=True,
+            header_style="bold green",
+            show_footer=False,
+            title="ECR Repositories List",
+        )
+        headers = ["Repository Name", "Image Quantity", "Image Size"]
+        if unique_layers:
+            headers.append("Unique Layers Size")
+        if scope:
+            headers = ["Account", "Region"] + headers
+        for header in headers:
+            self.table.add_column(header, justify="center")
+        self.table.row_styles = [
+            rich_style.Style(bgcolor="gray74", color="black"),
+            rich_style.Style(bgcolor="gray82", color="black"),
+        ]
+
+    def live(self):
+        return rich_live.Live(
+            rich_align.Align.center(self.table),
+            console=console,
+            screen=False,
+            refresh_per_second=20,
+        )
+
+    def add_repository(self, repo, images):
+        scope = [repo.account or "", repo.region or ""] if self.scope else []
+        self.table.add_row(
+            *scope,
+            repo.repository_name + (" (migrated)" if repo.migrated else ""),
+            str(repo.image_count()),
+            str(readable_size(repo.size_bytes())),
+            *self.unique_column(repo.unique_bytes),
+        )
+
+    def add_total(self, total_count, total_size, unique_bytes=None):
+        scope = ["", ""] if self.scope else []
+        self.table.add_row(
+            "Total",
+            *scope,
+            str(total_count),
+            str(readable_size(total_size)),
+            *self.unique_column(unique_bytes),
+            style="on green",
+        )
+
+    def unique_column(self, unique_bytes):
+        if not self.unique_layers:
+            return []
+        return ["-" if unique_bytes is None else str(readable_size(unique_bytes))]
+
+
+class StreamReport:
+    """
+    Headless report writing one JSONL/CSV record per repository (and per
+    image, if required) as soon as each repository is described
+    """
+
+    CSV_FIELDS = [
+        "record",
+        "repository_name",
+        "image_count",
+        "size_bytes",
+        "unique_layer_bytes",
+        "migrated",
+        "digest",
+        "tags",
+        "pushed_at",
+    ]
+
+    def __init__(self, output_format, path=None, per_image=False, scope=False):
+        self.output_format = output_format
+        self.per_image = per_image
+        self.scope = scope
+        self.__lock = threading.Lock()
+        self.__file = open(path, "w", encoding="utf-8", newline="") if path else None
+        self.__stream = self.__file or sys.stdout
+        if output_format == "csv":
+            fields = self.CSV_FIELDS
+            if scope:
+                fields = fields[:1] + ["account", "region"] + fields[1:]
+            self.__writer = csv.DictWriter(self.__stream, fieldnames=fields)
+            self.__writer.writeheader()
+
+    @contextlib.contextmanager
+    def live(self):
+        try:
+            yield self
+        finally:
+            if self.__file:
+                self.__file.close()
+            else:
+                self.__stream.flush()
 
-        # console.log(f"ECR repository images founded: {len(image_list)}")
-        return image_list
+    def write(self, records, repo=None):
+        if self.scope and repo:
+            for record in records:
+                record["account"] = repo.account
+                record["region"] = repo.region
+        with self.__lock:
+            for record in records:
+                if self.output_format == "csv":
+                    self.__writer.writerow(record)
+                else:
+                    self.__stream.write(json.dumps(record) + "\n")
+            self.__stream.flush()
 
+    def add_repository(self, repo, images):
+        records = [
+            {
+                "record": "repository",
+                "repository_name": repo.repository_name,
+                "image_count": repo.image_count(),
+                "size_bytes": repo.size_bytes(),
+                "unique_layer_bytes": repo.unique_bytes,
+                "migrated": repo.migrated,
+            }
+        ]
+        if self.per_image:
+            for image in images:
+                records.append(
+                    {
+                        "record": "image",
+                        "repository_name": repo.repository_name,
+                        "size_bytes": image.size_bytes,
+                        "digest": image.digest,
+                        "tags": (
+                            " ".join(image.image_tags or [])
+                            if self.output_format == "csv"
+                            else image.image_tags
+                        ),
+                        "pushed_at": image.pushed_at.isoformat(),
+                    }
+                )
+        self.write(records, repo=repo)
 
-class ECRRepo:
+    def add_total(self, total_count, total_size, unique_bytes=None):
+        self.write(
+            [
+                {
+                    "record": "total",
+                    "image_count": total_count,
+                    "size_bytes": total_size,
+                    "unique_layer_bytes": unique_bytes,
+                }
+            ]
+        )
 
-    def __init__(self, repository_name):
-        self.repository_name = repository_name
-        self.images = []
 
+class VerifyReport:
+    """
+    Differences between origin and destiny written as JSONL/CSV records as
+    soon as each repository is compared, with the totals on a table at the end
+    """
 
-class ECRImage:
+    CSV_FIELDS = ["difference", "repository_name", "digest", "tags", "destiny_tags"]
 
-    def __init__(self, digest, tags, pushed_at, size_bytes):
-        self.digest = digest
-        self.image_tags = tags
-        self.pushed_at = pushed_at
-        self.size_bytes = size_bytes
-        self.size_readable = readable_size(self.size_bytes)
+    def __init__(self, output_format="jsonl", path=None):
+        self.output_format = output_format
+        self.repositories = 0
+        self.images = 0
+        self.missing_repositories = 0
+        self.missing_images = 0
+        self.mismatched_tags = 0
+        self.failed = 0
+        self.__lock = threading.Lock()
+        self.__differences = []
+        self.__file = open(path, "w", encoding="utf-8", newline="") if path else None
+        if self.__file and output_format == "csv":
+            self.__writer = csv.DictWriter(self.__file, fieldnames=self.CSV_FIELDS)
+            self.__writer.writeheader()
 
+    @property
+    def differences(self):
+        return self.missing_images + self.mismatched_tags + self.failed
 
-class Worker:
+    def add_repository(self, repository_name, image_count, differences, missing):
+        with self.__lock:
+            self.repositories += 1
+            self.images += image_count
+            self.missing_repositories += 1 if missing else 0
+            for difference in differences:
+                if difference["difference"] == "missing-tags":
+                    self.mismatched_tags += 1
+                else:
+                    self.missing_images += 1
+                if not self.__file:
+                    self.__differences.append(difference)
+                elif self.output_format == "csv":
+                    self.__writer.writerow(
+                        dict(
+                            difference,
+                            tags=" ".join(difference["tags"]),
+                            destiny_tags=" ".join(difference["destiny_tags"]),
+                        )
+                    )
+                else:
+                    self.__file.write(json.dumps(difference) + "\n")
+            if self.__file:
+                self.__file.flush()
+        if differences:
+            console.log(
+                f"[bold yellow]Repository {repository_name}: "
+                f"{len(differences)} differences on destiny[/bold yellow]"
+            )
 
-    def __init__(self, concurrent_threads):
-        self.concurrent_threads = concurrent_threads
+    def add_failure(self, repository_name, exc):
+        with self.__lock:
+            self.failed += 1
+        console.log(
+            f"[bold red]Failed to verify repository {repository_name}: {exc}[/bold red]"
+        )
 
-    def run(self, target, content):
-        results = []
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.concurrent_threads
-        ) as executor:
-            futures = [executor.submit(target, cont) for cont in content]
-            for future in concurrent.futures.as_completed(futures):
-                results.append(future.result())
-            return results
+    def close(self):
+        if self.__file:
+            self.__file.close()
+        if self.__differences:
+            table = rich_table.Table(title="Differences on destiny")
+            for field in self.CSV_FIELDS:
+                table.add_column(field.replace("_", " ").title())
+            for difference in self.__differences:
+                table.add_row(
+                    difference["difference"],
+                    difference["repository_name"],
+                    difference["digest"],
+                    " ".join(difference["tags"]),
+                    " ".join(difference["destiny_tags"]),
+                )
+            console.print(table)
+        table = rich_table.Table(title="Verification")
+        for column in [
+            "Repositories",
+            "Images",
+            "Missing Repositories",
+            "Missing Images",
+            "Mismatched Tags",
+            "Failed Repositories",
+        ]:
+            table.add_column(column, justify="right")
+        table.add_row(
+            str(self.repositories),
+            str(self.images),
+            str(self.missing_repositories),
+            str(self.missing_images),
+            str(self.mismatched_tags),
+            str(self.failed),
+        )
+        console.print(table)
 
 
 def multi_thread_images(image):
-    images = image.aws.list_images(image.repo.repository_name)
-    image.repo.images.extend(images)
-    image.table.add_row(
-        image.repo.repository_name,
-        str(len(image.repo.images)),
-        str(readable_size(sum([size.size_bytes for size in image.repo.images]))),
+    migrated = None
+    if image.journal:
+        migrated = image.journal.get_repository(image.repo.repository_name)
+    if migrated:
+        image.repo.migrated = True
+        image.repo.store.add_summary(image.repo.repository_name, *migrated)
+        images = []
+    elif image.inventory:
+        images = image.inventory.refresh(image.aws, image.repo.repository_name)
+        if image.selection:
+            images = image.selection.apply(images)
+        image.repo.add_images(images)
+    else:
+        images = image.aws.list_images(image.repo.repository_name, image.selection)
+        image.repo.add_images(images)
+    if image.accounting and not migrated:
+        image.repo.unique_bytes = image.accounting.account(
+            image.aws, image.repo.repository_name, images
+        )
+    image.report.add_repository(image.repo, images)
+    return len(images)
+
+
+def multi_thread_migrate(migrate):
+    try:
+        result = migrate.migration.copy_image(
+            migrate.repo.repository_name, migrate.image
+        )
+    except Exception as exc:
+        console.log(
+            f"[bold red]Failed to migrate {migrate.repo.repository_name}@{migrate.image.digest}: {exc}[/bold red]"
+        )
+        result = None
+    # Bytes of layers uploaded were already reported part by part, the rest of
+    # the image (layers already on destiny or failed) is accounted at its end
+    remaining = max(0, migrate.image.size_bytes - migrate.migration.reported_bytes())
+    progress.update(
+        migrate.task,
+        advance=remaining,
+        images=f"{migrate.migration.images_done}/{migrate.total}",
+    )
+    return result
+
+
+def multi_thread_verify(verify):
+    """
+    Compare the digests and tags of one repository: the origin images come
+    from the listing (or DescribeImages, when not listed yet) and the destiny
+    ones from ListImages, so no manifest or layer is pulled
+    """
+    repository_name = verify.repo.repository_name
+    try:
+        if verify.repo.image_count() and not verify.repo.migrated:
+            images = verify.repo.images
+        else:
+            images = verify.source.list_images(repository_name, verify.selection)
+        try:
+            destiny_ids = verify.destination.list_image_ids(repository_name)
+        except botocore_exceptions.ClientError as exc:
+            if exc.response["Error"]["Code"] != "RepositoryNotFoundException":
+                raise
+            destiny_ids = None
+    except Exception as exc:
+        verify.report.add_failure(repository_name, exc)
+        return None
+
+    differences = []
+    for image in images:
+        tags = image.image_tags or []
+        if destiny_ids is None or image.digest not in destiny_ids:
+            difference, destiny_tags = "missing-image", []
+        else:
+            destiny_tags = destiny_ids[image.digest]
+            if set(tags) <= set(destiny_tags):
+                continue
+            difference = "missing-tags"
+        differences.append(
+            {
+                "difference": difference,
+                "repository_name": repository_name,
+                "digest": image.digest,
+                "tags": sorted(tags),
+                "destiny_tags": sorted(destiny_tags),
+            }
+        )
+    verify.report.add_repository(
+        repository_name, len(images), differences, destiny_ids is None
     )
-    return images
+    return len(differences)
 
 
-Image = namedtuple("Image", ["aws", "repo", "table"])
+Image = namedtuple(
+    "Image",
+    ["aws", "repo", "report", "journal", "inventory", "accounting", "selection"],
+    defaults=[None, None],
+)
+Scan = namedtuple(
+    "Scan",
+    [
+        "aws_session",
+        "account",
+        "report",
+        "filter_type",
+        "filter",
+        "threads",
+        "metrics",
+        "selection",
+    ],
+    defaults=[None, None],
+)
+Migrate = namedtuple("Migrate", ["migration", "repo", "image", "task", "total"])
+Verify = namedtuple("Verify", ["source", "destination", "repo", "selection", "report"])
 
 
 @click.command()
@@ -237,9 +2137,15 @@ Image = namedtuple("Image", ["aws", "repo", "table"])
     required=False,
 )
 @click.option(
-    "--dest-profile-name", help="Set destiny AWS Profile Name", required=False
+    "--dest-profile-name",
+    help="Set destiny AWS Profile Name. Any destiny option enables the migration",
+    required=False,
+)
+@click.option(
+    "--dest-region",
+    help="Set destiny AWS Region Name (default: origin region)",
+    required=False,
 )
-@click.option("--dest-region", help="Set destiny AWS Region Name", required=False)
 @click.option("--dest-access-key", help="Set destiny AWS Access Key", required=False)
 @click.option("--dest-secret-key", help="Set destiny AWS Secret Key", required=False)
 @click.option(
@@ -257,9 +2163,199 @@ Image = namedtuple("Image", ["aws", "repo", "table"])
 @click.option(
     "--not-repo-regex", help="Set regex to not use ECR Repositories", required=False
 )
+@click.option(
+    "--tag-regex",
+    help="Set regex to select the image tags, only the matching tags are migrated",
+    required=False,
+)
+@click.option(
+    "--pushed-after",
+    help="Select only images pushed after this date (UTC)",
+    type=click.DateTime(),
+    required=False,
+)
+@click.option(
+    "--newest",
+    help="Select only the N newest images of each repository, ordered by --order",
+    type=click.IntRange(min=1),
+    required=False,
+)
+@click.option(
+    "--order",
+    help="Order used by --newest: push date or semantic version of the tags",
+    type=click.Choice(["pushed", "semver"]),
+    default="pushed",
+    show_default=True,
+)
+@click.option(
+    "--chunk-size",
+    help="Layer part size in MB streamed from origin to destiny (ECR accepts parts from 5MB to 20MB)",
+    default=20,
+    show_default=True,
+    type=click.IntRange(5, 20),
+)
+@click.option(
+    "--max-in-flight",
+    help="Maximum layer data in MB buffered in memory by all threads together",
+    default=500,
+    show_default=True,
+    type=click.IntRange(min=5),
+)
+@click.option(
+    "--schedule",
+    help="Order to migrate the images: largest first or the listing order",
+    type=click.Choice(["size", "listing"]),
+    default="size",
+    show_default=True,
+)
+@click.option(
+    "--max-bandwidth",
+    help="Maximum layer data in MB per second sent by all threads together",
+    type=click.FloatRange(min=0, min_open=True),
+    required=False,
+)
+@click.option(
+    "--verify",
+    help="Compare digests and tags of the selected origin images with destiny: "
+    "instead of migrating or after the migration. Exit status is 1 with differences",
+    type=click.Choice(["only", "after"]),
+    required=False,
+)
+@click.option(
+    "--diff-file",
+    help="Set file to write the differences found by --verify "
+    "(default: table on the console)",
+    required=False,
+)
+@click.option(
+    "--diff-format",
+    help="Format of --diff-file",
+    type=click.Choice(["jsonl", "csv"]),
+    default="jsonl",
+    show_default=True,
+)
+@click.option(
+    "--work-queue",
+    help="Set SQLite work queue shared by worker processes, on this host or on "
+    "hosts sharing the file: the filtered repositories are enqueued and each "
+    "worker claims, lists and migrates one repository at a time",
+    required=False,
+)
+@click.option(
+    "--queue-role",
+    help="Enqueue the repositories and work on them, only enqueue or only work",
+    type=click.Choice(["all", "enqueue", "worker"]),
+    default="all",
+    show_default=True,
+)
+@click.option(
+    "--processes",
+    help="Worker processes started on this host to consume the work queue",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--lease",
+    help="Seconds a claimed repository stays leased without renewal before "
+    "other workers can claim it again (crashed workers)",
+    default=300,
+    show_default=True,
+    type=click.IntRange(min=10),
+)
+@click.option(
+    "--journal",
+    help="Set SQLite file used to resume the migration "
+    "(default: ecr-migration-<arguments hash>.sqlite on current directory)",
+    required=False,
+)
+@click.option(
+    "--inventory",
+    help="Set JSON file to keep the images inventory. Later executions only "
+    "describe the images pushed since the last one",
+    required=False,
+)
+@click.option(
+    "--max-age",
+    help="Hours after which a repository on inventory is fully described again",
+    default=168,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--output",
+    help="Write the report as JSONL or CSV records instead of the table",
+    type=click.Choice(["jsonl", "csv"]),
+    required=False,
+)
+@click.option(
+    "--output-file",
+    help="Set file to write the --output records (default: stdout)",
+    required=False,
+)
+@click.option(
+    "--per-image",
+    help="Write one --output record per image besides the repository ones",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--scan-profile",
+    help="Set AWS Profile Name to scan, together with the other ones. "
+    "Enables the scan mode, that only lists the repositories",
+    required=False,
+    multiple=True,
+)
+@click.option(
+    "--scan-region",
+    help='Set AWS Region Name to scan on each profile, or "all" for all enabled regions. '
+    "Enables the scan mode, that only lists the repositories",
+    required=False,
+    multiple=True,
+)
+@click.option(
+    "--scan-parallel",
+    help="Accounts and regions scanned at the same time, each one with up to --threads",
+    default=20,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--unique-layers",
+    help="Fetch the image manifests to report the size of the distinct layers, "
+    "counting once the layers shared by tags and repositories",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--manifest-cache",
+    help="Set directory to cache the manifests used by --unique-layers",
+    default=os.path.join(
+        os.path.expanduser("~"), ".cache", "migrate-ecr-images", "manifests"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--metrics-json",
+    help="Save per ECR operation calls, latency, retries, throttles and bytes, "
+    "queue wait and wall/CPU time as JSON on this path when finished",
+)
+@click.option(
+    "--metrics-prometheus",
+    help="Write the metrics in Prometheus text format on this path, "
+    "refreshed every --metrics-interval seconds (node_exporter textfile)",
+)
+@click.option(
+    "--metrics-interval",
+    help="Seconds between writes of --metrics-prometheus",
+    default=10,
+    show_default=True,
+    type=int,
+)
 @click.option(
     "--threads",
-    help="Threads quantity to process data",
+    help="Threads quantity to process data. Describe calls start with 10 and "
+    "grow up to this value while ECR doesn't throttle",
     default=50,
     show_default=True,
     required=True,
@@ -278,6 +2374,35 @@ def migrate(
     not_repo,
     repo_regex,
     not_repo_regex,
+    tag_regex,
+    pushed_after,
+    newest,
+    order,
+    chunk_size,
+    max_in_flight,
+    schedule,
+    max_bandwidth,
+    verify,
+    diff_file,
+    diff_format,
+    work_queue,
+    queue_role,
+    processes,
+    lease,
+    journal,
+    inventory,
+    max_age,
+    output,
+    output_file,
+    per_image,
+    scan_profile,
+    scan_region,
+    scan_parallel,
+    unique_layers,
+    manifest_cache,
+    metrics_json,
+    metrics_prometheus,
+    metrics_interval,
     threads,
 ):
     """
@@ -290,76 +2415,674 @@ def migrate(
         raise EnvironmentError(
             "This options can't be defined together: Repo, Not-Repo, Repo-Regex, Not-Repo-Regex. Only one can be defined!"
         )
+    if max_in_flight < chunk_size:
+        raise EnvironmentError(
+            "Max-In-Flight can't be smaller than Chunk-Size, each thread buffers at least one part"
+        )
+    if output and not output_file:
+        # Keep stdout only with the records
+        console.file = sys.stderr
+    if output:
+        report = StreamReport(
+            output_format=output,
+            path=output_file,
+            per_image=per_image,
+            scope=bool(scan_profile or scan_region),
+        )
+    else:
+        report = TableReport(
+            scope=bool(scan_profile or scan_region), unique_layers=unique_layers
+        )
+    selection = ImageSelection(
+        tag_regex=tag_regex,
+        pushed_after=(
+            pushed_after.replace(tzinfo=datetime.timezone.utc) if pushed_after else None
+        ),
+        newest=newest,
+        order=order,
+    )
+    metrics = None
+    if metrics_json or metrics_prometheus:
+        metrics = Metrics()
+        if metrics_prometheus:
+            metrics.start_prometheus(metrics_prometheus, metrics_interval)
+
+    if scan_profile or scan_region:
+        if any([dest_profile_name, dest_region, dest_access_key, dest_secret_key]):
+            raise EnvironmentError("The scan mode can't be used to migrate images")
+        if inventory or unique_layers:
+            raise EnvironmentError(
+                "The scan mode can't be used with inventory or unique layers"
+            )
+        if not scan_profile and not profile_name:
+            raise EnvironmentError("The scan mode requires Profile Names")
+        filter_type, filter = repository_filter(
+            repo, not_repo, repo_regex, not_repo_regex
+        )
+        scan_registries(
+            profiles=scan_profile or [profile_name],
+            regions=scan_region or [region],
+            default_region=region,
+            report=report,
+            filter_type=filter_type,
+            filter=filter,
+            threads=threads,
+            parallel=scan_parallel,
+            metrics=metrics,
+            selection=selection,
+        )
+        if metrics:
+            metrics.stop(metrics_json, metrics_prometheus)
+        return
+
     aws_session = AWS(
         profile=profile_name,
         region=region,
         access_key=access_key,
         secret_key=secret_key,
+        log=console.log,
     ).get_session()
-    # dest_aws_session = AWS(
-    #     profile=dest_profile_name,
-    #     region=dest_region,
-    #     access_key=dest_access_key,
-    #     secret_key=dest_secret_key,
-    # ).get_session()
+    migrate_images = any(
+        [dest_profile_name, dest_region, dest_access_key, dest_secret_key]
+    )
+    if work_queue and not migrate_images:
+        raise EnvironmentError("The work queue requires the destiny credentials")
+    if verify and not migrate_images:
+        raise EnvironmentError("The verify mode requires the destiny credentials")
+    differences = 0
+    if migrate_images:
+        if not dest_profile_name and not dest_access_key and not dest_secret_key:
+            console.log(
+                "Destiny credentials not defined, origin credentials will be used"
+            )
+            dest_profile_name = profile_name
+            dest_access_key = access_key
+            dest_secret_key = secret_key
+        dest_aws_session = AWS(
+            profile=dest_profile_name,
+            region=dest_region or region,
+            access_key=dest_access_key,
+            secret_key=dest_secret_key,
+            log=console.log,
+        ).get_session()
+        if verify == "only":
+            if work_queue or inventory or unique_layers:
+                raise EnvironmentError(
+                    "The verify mode can't be used with work queue, inventory or unique layers"
+                )
+            concurrency = AdaptiveConcurrency(maximum=threads)
+            source = ECR(
+                aws_session=aws_session,
+                concurrency=concurrency,
+                max_pool_connections=threads,
+                metrics=metrics,
+            )
+            filter_type, filter = repository_filter(
+                repo, not_repo, repo_regex, not_repo_regex
+            )
+            differences = verify_destination(
+                source,
+                ECR(
+                    aws_session=dest_aws_session,
+                    concurrency=concurrency,
+                    max_pool_connections=threads,
+                    metrics=metrics,
+                ),
+                source.iter_repositories(filter_type=filter_type, filter=filter),
+                VerifyReport(output_format=diff_format, path=diff_file),
+                selection=selection,
+                threads=threads,
+                concurrency=concurrency,
+                metrics=metrics,
+            )
+            if metrics:
+                metrics.stop(metrics_json, metrics_prometheus)
+            if differences:
+                sys.exit(1)
+            return
+        if work_queue:
+            if journal or inventory or unique_layers or verify:
+                raise EnvironmentError(
+                    "The work queue can't be used with journal, inventory, unique layers or verify"
+                )
+            repo_iter = None
+            if queue_role != "worker":
+                console.log("List repositories on origin account to the work queue")
+                filter_type, filter = repository_filter(
+                    repo, not_repo, repo_regex, not_repo_regex
+                )
+                repo_iter = ECR(
+                    aws_session=aws_session, metrics=metrics
+                ).iter_repositories(filter_type=filter_type, filter=filter)
+            migrate_queue(
+                QueueSettings(
+                    queue=work_queue,
+                    lease=lease,
+                    origin=dict(
+                        profile=profile_name,
+                        region=region,
+                        access_key=access_key,
+                        secret_key=secret_key,
+                    ),
+                    destiny=dict(
+                        profile=dest_profile_name,
+                        region=dest_region or region,
+                        access_key=dest_access_key,
+                        secret_key=dest_secret_key,
+                    ),
+                    selection=selection,
+                    chunk_size=chunk_size,
+                    max_in_flight=max_in_flight,
+                    schedule=schedule,
+                    max_bandwidth=max_bandwidth,
+                    threads=threads,
+                ),
+                queue_role,
+                processes,
+                repo_iter=repo_iter,
+                metrics=metrics,
+            )
+            if metrics:
+                metrics.stop(metrics_json, metrics_prometheus)
+            return
+        journal = Journal(
+            journal
+            or journal_path(
+                profile_name,
+                region,
+                access_key,
+                dest_profile_name,
+                dest_region or region,
+                dest_access_key,
+                sorted(repo),
+                sorted(not_repo),
+                repo_regex,
+                not_repo_regex,
+                tag_regex,
+                pushed_after.isoformat() if pushed_after else None,
+                newest,
+                order if newest else None,
+            )
+        )
+        console.log(f"Migration journal: {journal.path}")
+    else:
+        journal = None
+    if inventory:
+        inventory = Inventory(inventory, max_age=max_age * 3600)
+    accounting = None
+    if unique_layers:
+        accounting = LayerAccounting(ManifestCache(manifest_cache))
     console.log("List repositories on origin account")
-    ecr = ECR(aws_session=aws_session)
+    concurrency = AdaptiveConcurrency(maximum=threads)
+    ecr = ECR(
+        aws_session=aws_session,
+        concurrency=concurrency,
+        max_pool_connections=threads,
+        metrics=metrics,
+    )
 
-    table = Table(
-        show_header=True,
-        header_style="bold green",
-        show_footer=False,
-        title="ECR Repositories List",
+    store = ImageStore()
+    filter_type, filter = repository_filter(repo, not_repo, repo_regex, not_repo_regex)
+    repo_iter = ecr.iter_repositories(
+        filter_type=filter_type, filter=filter, store=store
     )
-    table_centered = Align.center(table)
 
-    headers = ["Repository Name", "Image Quantity", "Image Size"]
-    for header in headers:
-        table.add_column(header, justify="center")
+    with report.live():
+        repo_list = []
+
+        def repo_tuple_iter():
+            for repo in repo_iter:
+                repo_list.append(repo)
+                yield Image(
+                    aws=ecr,
+                    repo=repo,
+                    report=report,
+                    journal=journal,
+                    inventory=inventory,
+                    accounting=accounting,
+                    selection=selection,
+                )
+
+        worker = Worker(
+            concurrent_threads=threads,
+            concurrency=concurrency,
+            metrics=metrics,
+            name="describe",
+        )
+        worker.run(multi_thread_images, repo_tuple_iter())
+
+        report.add_total(
+            store.total_count,
+            store.total_size,
+            accounting.total_bytes if accounting else None,
+        )
+    if accounting:
+        console.log(f"Manifests fetched from ECR (not cached): {accounting.fetched}")
+
+    if inventory:
+        inventory.save()
+
+    if migrate_images:
+        buffers = BufferPool(
+            chunk_size=chunk_size * 1024 * 1024,
+            max_in_flight=max_in_flight * 1024 * 1024,
+        )
+        destination = ECR(
+            aws_session=dest_aws_session,
+            max_pool_connections=threads,
+            metrics=metrics,
+        )
+        migrate_destination(
+            ecr,
+            destination,
+            repo_list,
+            buffers,
+            threads,
+            journal,
+            schedule=schedule,
+            bandwidth=(
+                BandwidthLimiter(max_bandwidth * 1024 * 1024) if max_bandwidth else None
+            ),
+            metrics=metrics,
+        )
+        if verify == "after":
+            differences = verify_destination(
+                ecr,
+                destination,
+                repo_list,
+                VerifyReport(output_format=diff_format, path=diff_file),
+                selection=selection,
+                threads=threads,
+                concurrency=concurrency,
+                metrics=metrics,
+            )
+    if metrics:
+        metrics.stop(metrics_json, metrics_prometheus)
+    if verify and differences:
+        sys.exit(1)
+
 
+def repository_filter(repo, not_repo, repo_regex, not_repo_regex):
     if repo:
-        repo_list = ecr.list_repositories(filter_type="common", filter=list(repo))
+        return "common", list(repo)
     elif not_repo:
-        repo_list = ecr.list_repositories(
-            filter_type="common-not", filter=list(not_repo)
-        )
+        return "common-not", list(not_repo)
     elif repo_regex:
-        repo_list = ecr.list_repositories(filter_type="regex", filter=repo_regex)
+        return "regex", repo_regex
     elif not_repo_regex:
-        repo_list = ecr.list_repositories(
-            filter_type="regex-not", filter=not_repo_regex
-        )
-    else:
-        repo_list = ecr.list_repositories()
+        return "regex-not", not_repo_regex
+    return None, None
 
-    table.row_styles = [
-        Style(bgcolor="gray74", color="black"),
-        Style(bgcolor="gray82", color="black"),
-    ]
 
-    with Live(table_centered, console=console, screen=False, refresh_per_second=20):
-        repo_tuple_list = []
-        for repo in repo_list:
-            repo_tuple_list.append(Image(aws=ecr, repo=repo, table=table))
+def scan_regions(aws_session, regions):
+    if "all" not in regions:
+        return list(regions)
+    client = aws_session.client("ec2")
+    enabled = [region["RegionName"] for region in client.describe_regions()["Regions"]]
+    ecr_regions = aws_session.get_available_regions("ecr")
+    return [region for region in enabled if region in ecr_regions]
 
-        worker = Worker(concurrent_threads=10)
-        worker.run(multi_thread_images, repo_tuple_list)
 
-        table.add_row(
-            "Total",
-            str(sum([len(repo.images) for repo in repo_list])),
-            str(
-                readable_size(
-                    sum(
-                        [
-                            sum([size.size_bytes for size in repo.images])
-                            for repo in repo_list
-                        ]
-                    )
+def multi_thread_scan(scan):
+    """
+    Describe every repository of one account and region with its own
+    adaptive concurrency, so each region respects its own API limits
+    """
+    store = ImageStore()
+    concurrency = AdaptiveConcurrency(maximum=scan.threads)
+    ecr = ECR(
+        aws_session=scan.aws_session,
+        concurrency=concurrency,
+        account=scan.account,
+        max_pool_connections=scan.threads,
+        metrics=scan.metrics,
+    )
+    try:
+        repo_iter = ecr.iter_repositories(
+            filter_type=scan.filter_type, filter=scan.filter, store=store
+        )
+        worker = Worker(
+            concurrent_threads=scan.threads,
+            concurrency=concurrency,
+            metrics=scan.metrics,
+            name="describe",
+        )
+        worker.run(
+            multi_thread_images,
+            (
+                Image(
+                    aws=ecr,
+                    repo=repo,
+                    report=scan.report,
+                    journal=None,
+                    inventory=None,
+                    selection=scan.selection,
                 )
+                for repo in repo_iter
             ),
-            style="on green",
         )
+    except Exception as exc:
+        console.log(
+            f"[bold red]Failed to scan {scan.account} on {ecr.region}: {exc}[/bold red]"
+        )
+    return store
+
+
+def scan_registries(
+    profiles,
+    regions,
+    default_region,
+    report,
+    filter_type,
+    filter,
+    threads,
+    parallel,
+    metrics=None,
+    selection=None,
+):
+    scan_list = []
+    for profile in profiles:
+        profile_session = AWS(
+            profile=profile, region=default_region, log=console.log
+        ).get_session()
+        account = profile_session.client("sts").get_caller_identity()["Account"]
+        profile_regions = scan_regions(profile_session, regions)
+        console.log(
+            f"Account {account} ({profile}) will be scanned on {len(profile_regions)} regions"
+        )
+        for region in profile_regions:
+            scan_list.append(
+                Scan(
+                    aws_session=get_session(profile=profile, region=region),
+                    account=account,
+                    report=report,
+                    filter_type=filter_type,
+                    filter=filter,
+                    threads=threads,
+                    metrics=metrics,
+                    selection=selection,
+                )
+            )
+
+    with report.live():
+        worker = Worker(concurrent_threads=min(parallel, len(scan_list) or 1))
+        stores = worker.run(multi_thread_scan, scan_list)
+        report.add_total(
+            sum(store.total_count for store in stores),
+            sum(store.total_size for store in stores),
+        )
+
+
+def migrate_destination(
+    source,
+    destination,
+    repo_list,
+    buffers,
+    threads=10,
+    journal=None,
+    schedule="size",
+    bandwidth=None,
+    metrics=None,
+    keep_task=True,
+):
+    """
+    Migrate the images not verified on the journal yet. Without keep_task,
+    the progress bar of this migration is removed at the end (the queue
+    workers call it once per repository on the same progress)
+    """
+    console.log("Migrating images to destiny account")
+    migration = ECRMigration(
+        source=source,
+        destination=destination,
+        buffers=buffers,
+        journal=journal,
+        bandwidth=bandwidth,
+    )
+    pending_list = []
+    already_total = 0
+    for repo in repo_list:
+        verified = journal.verified_images(repo.repository_name) if journal else set()
+        images = [image for image in repo.images if image.digest not in verified]
+        already_total += repo.image_count() - len(images) if not repo.migrated else 0
+        pending_list.append((repo, images))
+    pending_total = sum(len(images) for repo, images in pending_list)
+    if already_total:
+        console.log(f"Images already migrated on journal: {already_total}")
+
+    with progress:
+        migrate_task = progress.add_task(
+            "Migrating images",
+            total=sum(
+                image.size_bytes for repo, images in pending_list for image in images
+            ),
+            images=f"0/{pending_total}",
+        )
+        migration.on_bytes = lambda size: progress.update(migrate_task, advance=size)
+        migrate_list = []
+        for repo, images in pending_list:
+            for image in images:
+                migrate_list.append(
+                    Migrate(
+                        migration=migration,
+                        repo=repo,
+                        image=image,
+                        task=migrate_task,
+                        total=pending_total,
+                    )
+                )
+        if schedule == "size":
+            # Largest first, so the big images don't create a long tail at the end
+            migrate_list.sort(key=lambda item: item.image.size_bytes, reverse=True)
+
+        worker = Worker(concurrent_threads=threads, metrics=metrics, name="migrate")
+        try:
+            results = worker.run(multi_thread_migrate, migrate_list)
+        finally:
+            if not keep_task:
+                progress.remove_task(migrate_task)
+
+    results = [result for result in results if result]
+    if journal:
+        for repo in repo_list:
+            if repo.migrated:
+                continue
+            verified = journal.verified_images(repo.repository_name)
+            if all(image.digest in verified for image in repo.images):
+                journal.mark_repository(
+                    repo.repository_name,
+                    "done",
+                    repo.image_count(),
+                    repo.size_bytes(),
+                )
+    console.log(
+        f"Images migrated: {len(results)} of {len(migrate_list)} | "
+        f"Layers copied: {sum(result.layers_copied for result in results)} | "
+        f"Layers already on destiny: {sum(result.layers_skipped for result in results)} | "
+        f"Data copied: {readable_size(sum(result.bytes_copied for result in results))}"
+    )
+    return results
+
+
+def verify_destination(
+    source,
+    destination,
+    repo_iter,
+    report,
+    selection=None,
+    threads=10,
+    concurrency=None,
+    metrics=None,
+):
+    console.log("Verifying images on destiny account")
+    worker = Worker(
+        concurrent_threads=threads,
+        concurrency=concurrency,
+        metrics=metrics,
+        name="verify",
+    )
+    worker.run(
+        multi_thread_verify,
+        (
+            Verify(
+                source=source,
+                destination=destination,
+                repo=repo,
+                selection=selection,
+                report=report,
+            )
+            for repo in repo_iter
+        ),
+    )
+    report.close()
+    return report.differences
+
+
+QueueSettings = namedtuple(
+    "QueueSettings",
+    [
+        "queue",
+        "lease",
+        "origin",
+        "destiny",
+        "selection",
+        "chunk_size",
+        "max_in_flight",
+        "schedule",
+        "max_bandwidth",
+        "threads",
+    ],
+)
+
+
+def queue_process(settings, metrics=None):
+    """
+    Worker process of the work queue: origin and destiny are the AWS class
+    arguments, so each process creates its own sessions and clients
+    """
+    source = ECR(
+        aws_session=AWS(**settings.origin, log=console.log).get_session(),
+        max_pool_connections=settings.threads,
+        metrics=metrics,
+    )
+    destination = ECR(
+        aws_session=AWS(**settings.destiny, log=console.log).get_session(),
+        max_pool_connections=settings.threads,
+        metrics=metrics,
+    )
+    return queue_worker(
+        WorkQueue(settings.queue, lease=settings.lease),
+        f"{socket.gethostname()}:{os.getpid()}",
+        source,
+        destination,
+        settings.selection,
+        BufferPool(
+            chunk_size=settings.chunk_size * 1024 * 1024,
+            max_in_flight=settings.max_in_flight * 1024 * 1024,
+        ),
+        threads=settings.threads,
+        schedule=settings.schedule,
+        bandwidth=(
+            BandwidthLimiter(settings.max_bandwidth * 1024 * 1024)
+            if settings.max_bandwidth
+            else None
+        ),
+        metrics=metrics,
+    )
+
+
+def queue_worker(
+    work_queue,
+    owner,
+    source,
+    destination,
+    selection,
+    buffers,
+    threads=10,
+    schedule="size",
+    bandwidth=None,
+    metrics=None,
+):
+    """
+    Claim repositories until the queue is empty, renewing the lease on a
+    background thread while each one is listed and migrated
+    """
+    stop = threading.Event()
+
+    def renew_lease():
+        while not stop.wait(work_queue.lease / 3):
+            work_queue.renew(owner)
+
+    renewer = threading.Thread(target=renew_lease, daemon=True)
+    renewer.start()
+    migrated = 0
+    try:
+        while True:
+            repository_name = work_queue.claim(owner)
+            if repository_name is None:
+                if not work_queue.remaining():
+                    break
+                # Repositories leased by other workers, wait for them or their lease
+                time.sleep(min(5, work_queue.lease / 3))
+                continue
+            console.log(f"Worker {owner} claimed repository: {repository_name}")
+            repo = ECRRepo(repository_name)
+            try:
+                repo.add_images(source.list_images(repository_name, selection))
+                results = migrate_destination(
+                    source,
+                    destination,
+                    [repo],
+                    buffers,
+                    threads,
+                    schedule=schedule,
+                    bandwidth=bandwidth,
+                    metrics=metrics,
+                    keep_task=False,
+                )
+                success = len(results) == repo.image_count()
+            except Exception as exc:
+                console.log(
+                    f"[bold red]Failed to migrate repository {repository_name}: {exc}[/bold red]"
+                )
+                success = False
+            status = work_queue.finish(
+                repository_name, owner, success, repo.image_count(), repo.size_bytes()
+            )
+            if status == "done":
+                migrated += 1
+            elif status == "lost":
+                console.log(
+                    f"[bold yellow]Lease of repository {repository_name} expired, it was claimed by another worker[/bold yellow]"
+                )
+    finally:
+        stop.set()
+        renewer.join()
+    return migrated
+
+
+def migrate_queue(settings, role, processes, repo_iter=None, metrics=None):
+    work_queue = WorkQueue(settings.queue, lease=settings.lease)
+    if repo_iter is not None:
+        added = work_queue.add(repo.repository_name for repo in repo_iter)
+        console.log(f"Repositories added to the work queue {settings.queue}: {added}")
+    if role != "enqueue":
+        context = multiprocessing.get_context("spawn")
+        children = [
+            context.Process(target=queue_process, args=(settings,))
+            for _ in range(processes - 1)
+        ]
+        for child in children:
+            child.start()
+        # This process is a worker too, the only one with metrics
+        queue_process(settings, metrics)
+        for child in children:
+            child.join()
+    counts = work_queue.counts()
+    console.log(
+        "Work queue: "
+        + " | ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+    )
+    return counts
 
 
 if __name__ == "__main__":
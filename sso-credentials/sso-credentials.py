@@ -1,19 +1,42 @@
 #!/usr/bin/python3
 
-import boto3
-import urllib3
 import re
 import os
+import sys
 import time
 import socket
 import json
 import webbrowser
-import inquirer
 import logging
 import argparse
-import unidecode
-from configobj import ConfigObj
-from bs4 import BeautifulSoup
+import datetime
+import hashlib
+import concurrent.futures
+import contextlib
+import functools
+import shlex
+import socketserver
+import subprocess
+from collections import namedtuple
+import threading
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from aws_common import atomic_write, get_client, lazy_import, retry  # noqa: E402
+
+bs4 = lazy_import("bs4")
+botocore = lazy_import("botocore")
+botocore_config = lazy_import("botocore.config")
+botocore_exceptions = lazy_import("botocore.exceptions")
+configobj = lazy_import("configobj")
+fernet = lazy_import("cryptography.fernet")
+inquirer = lazy_import("inquirer")
+unidecode = lazy_import("unidecode")
+urllib3 = lazy_import("urllib3")
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
@@ -28,10 +51,30 @@ def get_hostname():
     return hostname
 
 
-def get_region_sso(sso_url):
+REGION_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "sso-credentials", "regions.json"
+)
+region_cache_lock = threading.Lock()
+
+
+def get_region_sso(sso_url, http=None, cache_path=REGION_CACHE):
+    """
+    Region of the SSO URL, from its start page only on the first time: the
+    regions are kept on cache_path
+    """
+    with region_cache_lock:
+        try:
+            with open(cache_path, encoding="utf-8") as cache_file:
+                regions = json.load(cache_file)
+        except (OSError, ValueError):
+            regions = {}
+    if sso_url in regions:
+        logger.info(f"SSO region from cache: {regions[sso_url]}")
+        return regions[sso_url]
+
     logger.info("Searching SSO region")
     regex_region = r"^\s{1,}.*(content\=\"(?P<region>.*)\").*$"
-    http = urllib3.PoolManager()
+    http = http or urllib3.PoolManager()
     logger.info(f"Opening connection page: {sso_url}")
     req = http.request("GET", sso_url)
     if req.status == 200:
@@ -39,21 +82,174 @@ def get_region_sso(sso_url):
     else:
         logger.error(req.data)
     req = req.data.decode("utf-8")
-    soup = BeautifulSoup(req, "html.parser")
+    # Only the element with the region is parsed
+    soup = bs4.BeautifulSoup(req, "html.parser", parse_only=bs4.SoupStrainer(id="env"))
     region = soup.find(id="env").get_text()
     region = json.loads(region)["region"]
+    with region_cache_lock:
+        try:
+            with open(cache_path, encoding="utf-8") as cache_file:
+                regions = json.load(cache_file)
+        except (OSError, ValueError):
+            regions = {}
+        regions[sso_url] = region
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        atomic_write(cache_path, json.dumps(regions))
     return region
 
 
-def get_token(client_name, region, sso_url):
+class SSOTokenCache:
+    """
+    Client registration and tokens stored on ~/.aws/sso/cache with the same
+    format of AWS CLI and botocore: the token file is named by the SHA1 of the
+    start URL, so the written profiles use it without `aws sso login`
+    """
+
+    SCOPES = ["sso:account:access"]
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+    # Tokens closer than this of their expiration are refreshed
+    EXPIRY_WINDOW = 300
+
+    def __init__(self, sso_url, region, directory=None):
+        self.sso_url = sso_url
+        self.region = region
+        self.directory = directory or os.path.join(
+            os.path.expanduser("~"), ".aws", "sso", "cache"
+        )
+        self.token_path = os.path.join(
+            self.directory, f"{hashlib.sha1(sso_url.encode('utf-8')).hexdigest()}.json"
+        )
+        registration_key = json.dumps(
+            {
+                "tool": "sso-credentials",
+                "startUrl": sso_url,
+                "region": region,
+                "scopes": self.SCOPES,
+            },
+            sort_keys=True,
+        )
+        self.registration_path = os.path.join(
+            self.directory,
+            f"{hashlib.sha1(registration_key.encode('utf-8')).hexdigest()}.json",
+        )
+
+    def expired(self, expires_at):
+        expires_at = datetime.datetime.strptime(expires_at, self.DATE_FORMAT).replace(
+            tzinfo=datetime.timezone.utc
+        )
+        remaining = expires_at - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() < self.EXPIRY_WINDOW
+
+    def expires_at(self, seconds):
+        return (
+            datetime.datetime.now(datetime.timezone.utc)
+            + datetime.timedelta(seconds=seconds)
+        ).strftime(self.DATE_FORMAT)
+
+    def read(self, path):
+        try:
+            with open(path, encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, path, content):
+        os.makedirs(self.directory, exist_ok=True)
+        atomic_write(path, json.dumps(content), mode=0o600)
+
+    def token(self):
+        """
+        Cached token of the start URL, valid or expired (its refresh token can
+        still be used)
+        """
+        token = self.read(self.token_path)
+        if token and token.get("startUrl") == self.sso_url and "accessToken" in token:
+            return token
+        return None
+
+    def save_token(self, token_response, registration):
+        token = {
+            "startUrl": self.sso_url,
+            "region": self.region,
+            "accessToken": token_response["accessToken"],
+            "expiresAt": self.expires_at(token_response["expiresIn"]),
+            "clientId": registration["clientId"],
+            "clientSecret": registration["clientSecret"],
+            "registrationExpiresAt": registration["expiresAt"],
+        }
+        if "refreshToken" in token_response:
+            token["refreshToken"] = token_response["refreshToken"]
+        self.write(self.token_path, token)
+        return token
+
+    def registration(self):
+        registration = self.read(self.registration_path)
+        if registration and not self.expired(registration["expiresAt"]):
+            return registration
+        return None
+
+    def save_registration(self, register):
+        registration = {
+            "clientId": register["clientId"],
+            "clientSecret": register["clientSecret"],
+            "expiresAt": datetime.datetime.fromtimestamp(
+                register["clientSecretExpiresAt"], datetime.timezone.utc
+            ).strftime(self.DATE_FORMAT),
+            "scopes": self.SCOPES,
+        }
+        self.write(self.registration_path, registration)
+        return registration
+
+
+@functools.lru_cache(maxsize=None)
+def unsigned_config(max_pool_connections=10):
+    """
+    SSO and SSO OIDC calls are authorized by the SSO token, so their clients
+    aren't signed and don't resolve credentials: a profile whose
+    credential_process is this script would call it back (and wait for it)
+    """
+    return botocore_config.Config(
+        signature_version=botocore.UNSIGNED, max_pool_connections=max_pool_connections
+    )
+
+
+def get_token(client_name, region, sso_url, force_login=False, interactive=True):
     logger.info("Starting process to get token")
-    client = boto3.client("sso-oidc", region_name=region)
-    logger.info("Registering client")
-    register = client.register_client(clientName=client_name, clientType="public")
+    cache = SSOTokenCache(sso_url, region)
+    token = None if force_login else cache.token()
+    if token and not cache.expired(token["expiresAt"]):
+        logger.info(f"Using cached token: {cache.token_path}")
+        return token["accessToken"]
+
+    client = get_client("sso-oidc", region=region, config=unsigned_config())
+    registration = cache.registration()
+    if token and token.get("refreshToken") and registration:
+        logger.info("Refreshing cached token")
+        try:
+            token_response = client.create_token(
+                clientId=registration["clientId"],
+                clientSecret=registration["clientSecret"],
+                grantType="refresh_token",
+                refreshToken=token["refreshToken"],
+            )
+            return cache.save_token(token_response, registration)["accessToken"]
+        except Exception as exc:
+            logger.info(f"Was not possible to refresh token, authorizing again: {exc}")
+
+    if not interactive:
+        logger.error("SSO token expired, execute this script to authorize again")
+        return None
+    if not registration:
+        logger.info("Registering client")
+        registration = cache.save_registration(
+            client.register_client(
+                clientName=client_name, clientType="public", scopes=cache.SCOPES
+            )
+        )
     logger.info("Starting device authorization")
     authz = client.start_device_authorization(
-        clientId=register.get("clientId"),
-        clientSecret=register.get("clientSecret"),
+        clientId=registration["clientId"],
+        clientSecret=registration["clientSecret"],
         startUrl=sso_url,
     )
     logger.info("Opening browser to authorize session")
@@ -68,8 +264,8 @@ def get_token(client_name, region, sso_url):
     while flag_verify:
         try:
             token_response = client.create_token(
-                clientId=register.get("clientId"),
-                clientSecret=register.get("clientSecret"),
+                clientId=registration["clientId"],
+                clientSecret=registration["clientSecret"],
                 grantType="urn:ietf:params:oauth:grant-type:device_code",
                 deviceCode=authz.get("deviceCode"),
             )
@@ -81,95 +277,687 @@ def get_token(client_name, region, sso_url):
             flag_verify = False
     if token_response:
         logger.debug("Token was generated with success")
-        return token_response.get("accessToken")
+        return cache.save_token(token_response, registration)["accessToken"]
     else:
         logger.error("Was not possible to generate token")
         return None
 
 
-def configure_credentials_file(account_list, sso_url, region):
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on a file next to path, so concurrent executions don't
+    write the same file at the same time
+    """
+    with open(f"{path}.lock", "a+") as lock_file:
+        if os.name == "nt":
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_config_file(file_location, sections, remove=()):
+    """
+    Update the sections on the file and remove the sections on remove, keeping
+    the others, with a single write through a temporary file renamed over it,
+    only when something changed
+    """
+    os.makedirs(os.path.dirname(file_location), exist_ok=True)
+    with file_lock(file_location):
+        config = configobj.ConfigObj(file_location, list_values=False)
+        changed = [
+            name for name, values in sections.items() if config.get(name) != values
+        ]
+        removed = [name for name in remove if name in config]
+        if not changed and not removed:
+            logger.info(f"File already updated: {file_location}")
+            return False
+        for name in changed:
+            logger.info(f"Writing account informations: {name}")
+            config[name] = sections[name]
+        for name in removed:
+            logger.info(f"Removing account no longer on the organization: {name}")
+            del config[name]
+        config.filename = None
+        atomic_write(
+            file_location,
+            "\n".join(config.write()) + "\n",
+            # Existing files keep their mode, new ones are only for the user
+            mode=None if os.path.exists(file_location) else 0o600,
+            fsync=True,
+        )
+        logger.info(
+            f"Sections written on {file_location}: {len(changed)} | removed: {len(removed)}"
+        )
+    return True
+
+
+class RoleSelector:
+    """
+    Roles of each account chosen without prompting, in this order: overrides
+    file (account id or name to a role or list of roles), all roles (one
+    profile per role), the only role, the first preference regex matching a
+    role and the roles already configured on the profiles.
+    Accounts still ambiguous are chosen together on a single screen
+    """
+
+    def __init__(self, preferences=(), overrides=None, per_role=False, prompt=True):
+        self.preferences = [re.compile(preference) for preference in preferences]
+        self.overrides = {}
+        if overrides:
+            with open(overrides, encoding="utf-8") as overrides_file:
+                self.overrides = json.load(overrides_file)
+        self.per_role = per_role
+        self.prompt = prompt
+        self.previous = {}
+
+    def select(self, account):
+        """
+        Roles chosen to the account, None when it's ambiguous
+        """
+        override = self.overrides.get(account.id) or self.overrides.get(
+            account.original_name
+        )
+        if override:
+            roles = [override] if isinstance(override, str) else override
+            missing = [role for role in roles if role not in account.roles]
+            if missing:
+                logger.info(f"Override roles not found on {account.name}: {missing}")
+            return [role for role in roles if role in account.roles]
+        if self.per_role or len(account.roles) == 1:
+            return list(account.roles)
+        for preference in self.preferences:
+            for role in account.roles:
+                if preference.search(role):
+                    return [role]
+        previous = [
+            role for role in self.previous.get(account.id, []) if role in account.roles
+        ]
+        return previous or None
+
+    def choose(self, accounts):
+        """
+        Single multi-select screen with the roles of all ambiguous accounts.
+        An account with more than one role selected has one profile per role
+        """
+        if not self.prompt:
+            for account in accounts:
+                logger.info(
+                    f"Account ignored, its role can't be chosen without prompt: {account.name}"
+                )
+            return {}
+        questions = [
+            inquirer.Checkbox(
+                "roles",
+                message="Choose desired Roles to the accounts (space to select, enter to finish)",
+                choices=[
+                    (f"{account.name}: {role}", (account.id, role))
+                    for account in accounts
+                    for role in account.roles
+                ],
+            )
+        ]
+        answer = inquirer.prompt(questions)
+        chosen = {}
+        for account_id, role in answer["roles"] if answer else []:
+            chosen.setdefault(account_id, []).append(role)
+        return chosen
+
+
+def stale_profiles(file_location, sso_url, account_ids, profiles):
+    """
+    Profiles of the SSO URL on the file whose accounts aren't on account_ids
+    (the organization) anymore. Accounts still on the organization keep their
+    profiles, even when skipped on this execution
+    """
+    if not os.path.exists(file_location):
+        return []
+    config = configobj.ConfigObj(file_location, list_values=False)
+    return [
+        name
+        for name, values in config.items()
+        if isinstance(values, dict)
+        and values.get("sso_start_url") == sso_url
+        and profile_role(values)[0] not in account_ids
+        and name not in profiles
+    ]
+
+
+def profile_role(values):
+    """
+    Account id and role of a profile, from the sso keys or from the arguments
+    of its credential_process
+    """
+    if "credential_process" in values:
+        arguments = shlex.split(values["credential_process"])
+        try:
+            return (
+                arguments[arguments.index("--account-id") + 1],
+                arguments[arguments.index("--role-name") + 1],
+            )
+        except (ValueError, IndexError):
+            return None, None
+    return values.get("sso_account_id"), values.get("sso_role_name")
+
+
+def credential_process_command(sso_url, region, account_id, role, daemon_arguments=()):
+    return shlex.join(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--credential-process",
+            "--url",
+            sso_url,
+            "--sso-region",
+            region,
+            "--account-id",
+            account_id,
+            "--role-name",
+            role,
+        ]
+        + list(daemon_arguments)
+    )
+
+
+def configured_roles(file_location, sso_url):
+    """
+    Roles of each account id on the profiles of the SSO URL on the file
+    """
+    if not os.path.exists(file_location):
+        return {}
+    config = configobj.ConfigObj(file_location, list_values=False)
+    roles = {}
+    for values in config.values():
+        if isinstance(values, dict) and values.get("sso_start_url") == sso_url:
+            account_id, role = profile_role(values)
+            roles.setdefault(account_id, []).append(role)
+    return roles
+
+
+Organization = namedtuple("Organization", ["sso_url", "region", "accounts"])
+
+
+def configure_credentials_file(
+    organizations, prune=False, selector=None, credential_process=None
+):
+    """
+    Write the profiles of all organizations on a single write of each file.
+    With credential_process (the daemon arguments, can be empty), the profiles
+    get their credentials from the local credentials daemon instead of the SSO
+    resolution of the SDKs
+    """
     file_location = os.path.join(
         os.path.expanduser("~"), f".aws{os.path.sep}credentials"
     )
-    logger.info(f"Writing credentials file: {file_location}")
-    config = ConfigObj(file_location)
-    for account in account_list:
-        logger.info(f"Writing account informations: {account.name}")
-        config[account.name] = {}
-        config[account.name]["sso_start_url"] = sso_url
-        config[account.name]["sso_region"] = region
-        config[account.name]["sso_account_id"] = account.id
-        if len(account.roles) > 1:
-            questions = [
-                inquirer.List(
-                    "role",
-                    message=f"Choose desired Role to this account: {account.name}",
-                    choices=account.roles,
+    selector = selector or RoleSelector()
+    selector.previous = {}
+    for organization in organizations:
+        selector.previous.update(configured_roles(file_location, organization.sso_url))
+    selected = {}
+    ambiguous = []
+    for organization in organizations:
+        for account in organization.accounts:
+            if not account.roles:
+                logger.info(f"Account without roles to this user: {account.name}")
+                continue
+            roles = selector.select(account)
+            if roles is None:
+                ambiguous.append(account)
+            else:
+                selected[account.id] = roles
+    if ambiguous:
+        logger.info(f"Accounts with more than one role to choose: {len(ambiguous)}")
+        selected.update(selector.choose(ambiguous))
+
+    credentials = {}
+    config = {}
+    for organization in organizations:
+        for account in organization.accounts:
+            roles = selected.get(account.id)
+            if not roles:
+                continue
+            for role in roles:
+                name = account.name if len(roles) == 1 else account.profile_name(role)
+                if name in credentials:
+                    logger.info(
+                        f"Profile name used by more than one account, use different prefixes: {name}"
+                    )
+                credentials[name] = {
+                    "sso_start_url": organization.sso_url,
+                    "sso_region": organization.region,
+                }
+                if credential_process is not None:
+                    # sso_account_id and sso_role_name would make the SDKs use SSO
+                    credentials[name]["credential_process"] = (
+                        credential_process_command(
+                            organization.sso_url,
+                            organization.region,
+                            account.id,
+                            role,
+                            credential_process,
+                        )
+                    )
+                else:
+                    credentials[name]["sso_account_id"] = account.id
+                    credentials[name]["sso_role_name"] = role
+                config[name] = {
+                    "region": "us-east-1",
+                    "format": "json",
+                    "output": "json",
+                }
+
+    removed = []
+    if prune:
+        for organization in organizations:
+            removed.extend(
+                stale_profiles(
+                    file_location,
+                    organization.sso_url,
+                    {account.id for account in organization.accounts},
+                    credentials,
                 )
-            ]
-            answer = inquirer.prompt(questions)
-            config[account.name]["sso_role_name"] = answer["role"]
-        else:
-            config[account.name]["sso_role_name"] = account.roles[0]
-        # config.comments[account.name].insert(0, "") # Add blank line
-        config.write()
+            )
+    logger.info(f"Writing credentials file: {file_location}")
+    write_config_file(file_location, credentials, remove=removed)
 
     file_location = os.path.join(os.path.expanduser("~"), f".aws{os.path.sep}config")
     logger.info(f"Writing config file: {file_location}")
-    config = ConfigObj(file_location)
-    for account in account_list:
-        logger.info(f"Writing account informations: {account.name}")
-        config[account.name] = {}
-        config[account.name]["region"] = "us-east-1"
-        config[account.name]["format"] = "json"
-        config[account.name]["output"] = "json"
-        # config.comments[account.name].insert(0, "") # Add blank line
-        config.write()
+    write_config_file(file_location, config, remove=removed)
+
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "sso-credentials")
+SOCKET_PATH = os.path.join(CACHE_DIRECTORY, "credentials.sock")
+
+
+class RoleCredentialsCache:
+    """
+    Role credentials kept in memory until shortly before their expiration,
+    fetched with GetRoleCredentials on demand (one call per role at a time).
+    With disk_path, they're saved encrypted (Fernet, key on a 0600 file), so
+    a restarted daemon doesn't fetch them again
+    """
+
+    EXPIRY_WINDOW = 300
+
+    def __init__(self, client_name, disk_path=None):
+        self.client_name = client_name
+        self.disk_path = disk_path
+        self.__lock = threading.Lock()
+        self.__role_locks = {}
+        self.__token_locks = {}
+        self.__credentials = {}
+        self.__fernet = None
+        if disk_path:
+            self.__load()
+
+    def __key(self):
+        key_path = f"{self.disk_path}.key"
+        if not os.path.exists(key_path):
+            os.makedirs(os.path.dirname(key_path), mode=0o700, exist_ok=True)
+            file_descriptor = os.open(
+                key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600
+            )
+            with os.fdopen(file_descriptor, "wb") as key_file:
+                key_file.write(fernet.Fernet.generate_key())
+        with open(key_path, "rb") as key_file:
+            return key_file.read()
+
+    def __load(self):
+        self.__fernet = fernet.Fernet(self.__key())
+        try:
+            with open(self.disk_path, "rb") as cache_file:
+                entries = json.loads(self.__fernet.decrypt(cache_file.read()))
+        except (OSError, ValueError, fernet.InvalidToken):
+            return
+        for entry in entries:
+            self.__credentials[tuple(entry["key"])] = entry["credentials"]
+
+    def __save(self):
+        with self.__lock:
+            entries = [
+                {"key": list(key), "credentials": credentials}
+                for key, credentials in self.__credentials.items()
+            ]
+        content = self.__fernet.encrypt(json.dumps(entries).encode("utf-8"))
+        atomic_write(self.disk_path, content, mode=0o600)
+
+    def valid(self, credentials):
+        expiration = datetime.datetime.strptime(
+            credentials["Expiration"], SSOTokenCache.DATE_FORMAT
+        ).replace(tzinfo=datetime.timezone.utc)
+        remaining = expiration - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() > self.EXPIRY_WINDOW
+
+    def get(self, sso_url, region, account_id, role):
+        key = (sso_url, account_id, role)
+        with self.__lock:
+            role_lock = self.__role_locks.setdefault(key, threading.Lock())
+        with role_lock:
+            credentials = self.__credentials.get(key)
+            if credentials and self.valid(credentials):
+                return credentials
+            with self.__lock:
+                token_lock = self.__token_locks.setdefault(sso_url, threading.Lock())
+            # Roles of the same SSO URL share its token, refreshed by one at a
+            # time (the refresh token may be rotated on each use)
+            with token_lock:
+                token = get_token(self.client_name, region, sso_url, interactive=False)
+            if not token:
+                raise PermissionError(
+                    f"SSO token of {sso_url} expired, execute sso-credentials.py to authorize again"
+                )
+            logger.info(f"Getting role credentials: {account_id} {role}")
+            client = get_client("sso", region=region, config=unsigned_config())
+            role_credentials = client.get_role_credentials(
+                roleName=role, accountId=account_id, accessToken=token
+            )["roleCredentials"]
+            credentials = {
+                "Version": 1,
+                "AccessKeyId": role_credentials["accessKeyId"],
+                "SecretAccessKey": role_credentials["secretAccessKey"],
+                "SessionToken": role_credentials["sessionToken"],
+                "Expiration": datetime.datetime.fromtimestamp(
+                    role_credentials["expiration"] / 1000, datetime.timezone.utc
+                ).strftime(SSOTokenCache.DATE_FORMAT),
+            }
+            with self.__lock:
+                self.__credentials[key] = credentials
+        if self.__fernet:
+            self.__save()
+        return credentials
+
+
+class CredentialsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.last_request = time.monotonic()
+        line = self.rfile.readline()
+        if not line:
+            # Connection only checking if the daemon is alive
+            return
+        try:
+            request = json.loads(line)
+            response = self.server.credentials.get(
+                request["url"],
+                request["region"],
+                request["account_id"],
+                request["role"],
+            )
+        except Exception as exc:
+            logger.error(f"Was not possible to get role credentials: {exc}")
+            response = {"Error": str(exc)}
+        self.wfile.write(json.dumps(response).encode("utf-8"))
+
+
+def serve_credentials(socket_path, idle_timeout, disk_cache=False):
+    """
+    Credentials daemon listening on a Unix socket readable only by the user,
+    stopped after idle_timeout seconds without requests
+    """
+    directory = os.path.dirname(socket_path)
+    os.makedirs(directory, exist_ok=True)
+    # The directory may have been created by the region cache or the catalog
+    os.chmod(directory, 0o700)
+    # Daemons started at same time: only the first one binds, the others exit
+    with file_lock(socket_path):
+        if daemon_alive(socket_path):
+            logger.info(f"Credentials daemon already listening on {socket_path}")
+            return False
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, CredentialsHandler)
+        os.chmod(socket_path, 0o600)
+        inode = os.stat(socket_path).st_ino
+    server.daemon_threads = True
+    server.credentials = RoleCredentialsCache(
+        socket.gethostname(),
+        os.path.join(CACHE_DIRECTORY, "credentials.enc") if disk_cache else None,
+    )
+    server.last_request = time.monotonic()
+
+    def stop_when_idle():
+        while time.monotonic() - server.last_request < idle_timeout:
+            time.sleep(min(10, idle_timeout))
+        logger.info("Credentials daemon idle, stopping")
+        server.shutdown()
+
+    threading.Thread(target=stop_when_idle, daemon=True).start()
+    logger.info(f"Credentials daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        with file_lock(socket_path):
+            # Only the socket bound by this daemon, not one of a newer daemon
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(socket_path).st_ino == inode:
+                    os.remove(socket_path)
+    return True
+
+
+def daemon_alive(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def request_credentials(socket_path, request, timeout=30):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        client.shutdown(socket.SHUT_WR)
+        response = b""
+        while chunk := client.recv(65536):
+            response += chunk
+    return json.loads(response)
+
+
+def credential_process(request, socket_path=SOCKET_PATH, daemon_arguments=()):
+    """
+    credential_process client: asks the daemon (started when it isn't running)
+    and prints the credentials on the format expected by the AWS SDKs
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        # No Unix sockets (old Windows): credentials fetched by this process
+        response = RoleCredentialsCache(socket.gethostname()).get(
+            request["url"], request["region"], request["account_id"], request["role"]
+        )
+    else:
+        started = False
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                response = request_credentials(socket_path, request)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                if not started:
+                    # The daemon resolves no profile, one using this script would call it back
+                    environment = {
+                        name: value
+                        for name, value in os.environ.items()
+                        if name not in ("AWS_PROFILE", "AWS_DEFAULT_PROFILE")
+                    }
+                    subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__), "--daemon"]
+                        + list(daemon_arguments),
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        env=environment,
+                        start_new_session=True,
+                    )
+                    started = True
+                time.sleep(0.05)
+            except TimeoutError:
+                response = {"Error": "Credentials daemon didn't answer on time"}
+                break
+    if "Error" in response:
+        sys.stderr.write(f"{response['Error']}\n")
+        return 1
+    sys.stdout.write(json.dumps(response))
+    return 0
+
+
+class AccountCatalog:
+    """
+    Accounts and roles of an organization stored on a JSON file, so the roles
+    are only listed again for new accounts or after the TTL
+    """
+
+    def __init__(self, sso_url, ttl, directory=None):
+        self.ttl = ttl
+        directory = directory or os.path.join(
+            os.path.expanduser("~"), ".cache", "sso-credentials"
+        )
+        self.path = os.path.join(
+            directory, f"{hashlib.sha1(sso_url.encode('utf-8')).hexdigest()}.json"
+        )
+        self.__lock = threading.Lock()
+        try:
+            with open(self.path, encoding="utf-8") as catalog_file:
+                self.__accounts = json.load(catalog_file)["accounts"]
+        except (OSError, ValueError, KeyError):
+            self.__accounts = {}
+
+    def roles(self, account_id, name):
+        """
+        Cached roles of the account, None when it's new, renamed or stale
+        """
+        with self.__lock:
+            cached = self.__accounts.get(account_id)
+        if not cached or cached["name"] != name:
+            return None
+        if time.time() - cached["synced_at"] > self.ttl:
+            return None
+        return list(cached["roles"])
+
+    def update(self, account_id, name, roles):
+        with self.__lock:
+            self.__accounts[account_id] = {
+                "name": name,
+                "roles": roles,
+                "synced_at": time.time(),
+            }
+
+    def save(self, account_ids):
+        """
+        Save the catalog with only the accounts still on the organization
+        """
+        with self.__lock:
+            accounts = {
+                account_id: self.__accounts[account_id]
+                for account_id in account_ids
+                if account_id in self.__accounts
+            }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, json.dumps({"accounts": accounts}))
 
 
 class AWSIntegration:
-    def __init__(self, region, access_token):
-        self.__client = boto3.client("sso", region_name=region)
+    THROTTLING_ERRORS = ["TooManyRequestsException", "ThrottlingException"]
+
+    def __init__(self, region, access_token, threads=10, max_attempts=8):
+        self.__client = get_client(
+            "sso",
+            region=region,
+            config=unsigned_config(threads),
+        )
         self.access_token = access_token
+        self.threads = threads
+        self.max_attempts = max_attempts
+
+    def call(self, operation, **params):
+        """
+        Execute an API call retrying throttling errors with full jitter backoff
+        """
+        return retry(
+            lambda: operation(accessToken=self.access_token, **params),
+            lambda exc: isinstance(exc, botocore_exceptions.ClientError)
+            and exc.response["Error"]["Code"] in self.THROTTLING_ERRORS,
+            max_attempts=self.max_attempts,
+        )
 
-    def get_account_list(self, prefix, spelling, separator):
+    def list_account_roles(self, account, catalog=None):
+        next_token = None
+        while True:
+            params = {"accountId": account.id}
+            if next_token:
+                params["nextToken"] = next_token
+            role_list = self.call(self.__client.list_account_roles, **params)
+            for role in role_list["roleList"]:
+                account.roles.append(role["roleName"])
+            next_token = role_list.get("nextToken")
+            if not next_token:
+                break
+        logger.info(f"Were found {len(account.roles)} on the account {account.name}")
+        if catalog:
+            catalog.update(account.id, account.original_name, account.roles)
+        return account
+
+    def get_account_list(self, prefix, spelling, separator, catalog=None):
+        """
+        List the accounts and, as each page arrives, list the roles of its
+        accounts on a pool of threads (only new or stale accounts of catalog)
+        """
         logger.info("Obtaining accounts list")
-        accounts_info = {"account_list": [], "next_token": None}
-        run = True
-        while run:
-            if accounts_info["next_token"]:
-                accs = self.__client.list_accounts(
-                    accessToken=self.access_token, nextToken=accounts_info["next_token"]
-                )
-            else:
-                accs = self.__client.list_accounts(accessToken=self.access_token)
-            accounts_info["account_list"].extend(accs["accountList"])
-            if "nextToken" in accs:
-                accounts_info["next_token"] = accs["nextToken"]
-                logger.info("Looking for more accounts...")
-            else:
-                run = False
-                logger.info("Account search process finished")
-        logger.info(f"Accounts found: {len(accounts_info['account_list'])}")
         accounts = []
-        for account in accounts_info["account_list"]:
-            logger.info(f"Listing account roles: {account['accountName']}")
-            acc = Account(
-                id=account["accountId"],
-                name=account["accountName"],
-                prefix=prefix,
-                spelling=spelling,
-                separator=separator,
-            )
-            role_list = self.__client.list_account_roles(
-                accessToken=self.access_token, accountId=acc.id
-            )
-            for role in role_list["roleList"]:
-                acc.roles.append(role["roleName"])
+        futures = []
+        cached = 0
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads
+        ) as executor:
+            next_token = None
+            while True:
+                params = {"nextToken": next_token} if next_token else {}
+                accs = self.call(self.__client.list_accounts, **params)
+                for account in accs["accountList"]:
+                    acc = Account(
+                        id=account["accountId"],
+                        name=account["accountName"],
+                        prefix=prefix,
+                        spelling=spelling,
+                        separator=separator,
+                    )
+                    accounts.append(acc)
+                    roles = (
+                        catalog.roles(acc.id, acc.original_name) if catalog else None
+                    )
+                    if roles is not None:
+                        acc.roles = roles
+                        cached += 1
+                        continue
+                    logger.info(f"Listing account roles: {account['accountName']}")
+                    futures.append(
+                        executor.submit(self.list_account_roles, acc, catalog)
+                    )
+                next_token = accs.get("nextToken")
+                if next_token:
+                    logger.info("Looking for more accounts...")
+                else:
+                    logger.info("Account search process finished")
+                    break
             logger.info(
-                f"Were found {len(acc.roles)} on the account {account['accountName']}"
+                f"Accounts found: {len(accounts)} ({cached} roles from catalog)"
             )
-            accounts.append(acc)
+            # Roles are added to the accounts, result() only raises the errors
+            for future in futures:
+                future.result()
+        if catalog:
+            catalog.save([account.id for account in accounts])
 
         return accounts
 
@@ -177,9 +965,17 @@ class AWSIntegration:
 class Account:
     def __init__(self, id, name, prefix, spelling, separator):
         self.id = id
+        self.original_name = name
+        self.spelling = spelling
+        self.separator = separator
         self.name = self.normalize_name(name, prefix, spelling, separator)
         self.roles = []
 
+    def profile_name(self, role):
+        return self.normalize_name(
+            f"{self.name}{self.separator}{role}", None, self.spelling, self.separator
+        )
+
     def normalize_name(self, name, prefix, spelling, separator):
         name = name.lower() if spelling == "lower" else name.upper()
         name = f"{prefix}{separator}{name}" if prefix else name
@@ -197,24 +993,33 @@ if __name__ == "__main__":
         formatter_class=argparse.RawTextHelpFormatter,
         epilog="Important informations:\n"
         "- This script will connect through the SSO URL informed\n"
-        "- No credentials are stored\n"
+        "- No credentials are stored, only the SSO token is cached on ~/.aws/sso/cache (as AWS CLI does)\n"
         "- The authentication methods followed, are those suggested by AWS\n"
         "- Existing accounts will not be removed, but accounts with the same name will be overwritten\n"
-        "- If any account no longer exists in the organization, it will not be removed from the file\n"
+        '- If any account no longer exists in the organization, it will not be removed from the file (see option "prune")\n'
+        '- Accounts and roles are kept on ~/.cache/sso-credentials, only new accounts or older than the TTL are listed again (see option "catalog-ttl")\n'
         "- The AWS accounts, together with the policies defined, will only be listed, without any change\n\n"
         "Standard rules for defining account names (can be changed, see parameters):\n"
         '- All characters will be tiny (see the option "spelling")\n'
         '- Accents will be removed.If there is: "conexão" (PT-BR), it will be changed to "conexao" (non-alterable rule)\n'
-        '- Spaces will be replaced by trace/hyphen (see option "separator")',
+        '- Spaces will be replaced by trace/hyphen (see option "separator")\n\n'
+        'Credentials daemon (see option "use-credential-process"):\n'
+        "- The profiles call this script as credential_process, which asks a local daemon for the role credentials\n"
+        "- The daemon is started on demand, listens on ~/.cache/sso-credentials/credentials.sock (only the user can access)\n"
+        '- Role credentials are kept in memory until 5 minutes before expiration, and on disk only encrypted (see option "disk-cache")\n'
+        "- The SSO token is never requested by the daemon, execute this script again when it expires",
     )
     parser.add_argument(
         "--url",
-        required=True,
-        help="Enter SSO's address.Example: https://example.awsapps.com/start",
+        required=False,
+        action="append",
+        help="Enter SSO's address.Example: https://example.awsapps.com/start\n"
+        "Can be repeated to sync more than one organization at same time (use one --prefix for each one)",
     )
     parser.add_argument(
         "--prefix",
         required=False,
+        action="append",
         help='If you wish, enter a prefix for the accounts. (default: "%(default)s")'
         "This option is interesting when there is more than one organization involved\n"
         "\tExample:\n"
@@ -236,17 +1041,165 @@ if __name__ == "__main__":
         default="-",
         help='Enter the accounts separator (default: "%(default)s")',
     )
+    parser.add_argument(
+        "--threads",
+        required=False,
+        type=int,
+        default=10,
+        help='Threads used to list the roles of the accounts (default: "%(default)s")',
+    )
+    parser.add_argument(
+        "--force-login",
+        required=False,
+        action="store_true",
+        help="Ignore the cached token on ~/.aws/sso/cache and authorize on browser again",
+    )
+    parser.add_argument(
+        "--prune",
+        required=False,
+        action="store_true",
+        help="Remove the profiles of this SSO URL whose accounts no longer exist in the organization",
+    )
+    parser.add_argument(
+        "--catalog-ttl",
+        required=False,
+        type=float,
+        default=24,
+        help='Hours the roles of an account are kept on the catalog before being listed again, 0 lists all (default: "%(default)s")',
+    )
+    parser.add_argument(
+        "--role-preference",
+        required=False,
+        action="append",
+        default=[],
+        help="Regex of the preferred roles, can be repeated in order of preference. The first one matching a role\n"
+        "of an account chooses it without prompting (example: --role-preference '^Admin' --role-preference ReadOnly)",
+    )
+    parser.add_argument(
+        "--role-overrides",
+        required=False,
+        help='JSON file with the roles of specific accounts, by account id or name: {"123456789012": "Admin", "my-account": ["Admin", "ReadOnly"]}',
+    )
+    parser.add_argument(
+        "--profile-per-role",
+        required=False,
+        action="store_true",
+        help="Create one profile per role of each account, named as <account><separator><role>",
+    )
+    parser.add_argument(
+        "--no-prompt",
+        required=False,
+        action="store_true",
+        help="Never prompt: accounts whose role isn't chosen by the rules or by the existing profile are ignored",
+    )
+    parser.add_argument(
+        "--use-credential-process",
+        required=False,
+        action="store_true",
+        help="Write the profiles with credential_process, served by the credentials daemon of this script",
+    )
+    parser.add_argument(
+        "--credential-process",
+        required=False,
+        action="store_true",
+        help="Print the credentials of --account-id/--role-name as credential_process (used by the profiles)",
+    )
+    parser.add_argument("--sso-region", required=False, help=argparse.SUPPRESS)
+    parser.add_argument("--account-id", required=False, help=argparse.SUPPRESS)
+    parser.add_argument("--role-name", required=False, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--daemon",
+        required=False,
+        action="store_true",
+        help="Run the credentials daemon (started by --credential-process when it isn't running)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        required=False,
+        type=float,
+        help="Minutes without requests before the credentials daemon stops (default: 60)",
+    )
+    parser.add_argument(
+        "--disk-cache",
+        required=False,
+        action="store_true",
+        help="Keep the role credentials of the daemon on disk, encrypted, to survive restarts",
+    )
     args = parser.parse_args()
 
+    daemon_arguments = []
+    if args.idle_timeout is not None:
+        daemon_arguments += ["--idle-timeout", str(args.idle_timeout)]
+    if args.disk_cache:
+        daemon_arguments.append("--disk-cache")
+    if args.daemon:
+        idle_timeout = 60 if args.idle_timeout is None else args.idle_timeout
+        serve_credentials(SOCKET_PATH, idle_timeout * 60, disk_cache=args.disk_cache)
+        exit(0)
+    if not args.url:
+        parser.error("the following arguments are required: --url")
+    if args.credential_process:
+        if not (args.sso_region and args.account_id and args.role_name):
+            parser.error(
+                "--credential-process requires --sso-region, --account-id and --role-name"
+            )
+        request = {
+            "url": args.url[0],
+            "region": args.sso_region,
+            "account_id": args.account_id,
+            "role": args.role_name,
+        }
+        exit(credential_process(request, daemon_arguments=daemon_arguments))
+
     logger.info("Starting execution ...")
+    urls = list(dict.fromkeys(args.url))
+    if args.prefix and len(args.prefix) != len(urls):
+        parser.error("Inform one --prefix for each --url, in the same order")
+    prefixes = args.prefix or [None] * len(urls)
     client_name = get_hostname()
-    url = args.url
-    region = get_region_sso(url)
-    if not region:
+    http = urllib3.PoolManager(maxsize=len(urls))
+
+    def sync_organization(url, prefix):
+        try:
+            region = get_region_sso(url, http=http)
+            token = get_token(client_name, region, url, force_login=args.force_login)
+            if not token:
+                return None
+            aws = AWSIntegration(
+                region=region, access_token=token, threads=args.threads
+            )
+            accounts = aws.get_account_list(
+                spelling=args.spelling,
+                separator=args.separator,
+                prefix=prefix,
+                catalog=AccountCatalog(url, ttl=args.catalog_ttl * 3600),
+            )
+        except Exception as exc:
+            logger.error(f"Was not possible to list the accounts of {url}: {exc}")
+            return None
+        return Organization(sso_url=url, region=region, accounts=accounts)
+
+    # Organizations are authenticated and listed at same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        organizations = list(executor.map(sync_organization, urls, prefixes))
+    # Profiles of the organizations listed are written even when others failed
+    failed = [url for url, organization in zip(urls, organizations) if not organization]
+    for url in failed:
+        logger.error(f"Organization not synced, its profiles weren't changed: {url}")
+    organizations = [organization for organization in organizations if organization]
+    if not organizations:
         exit(1)
-    token = get_token(client_name, region, url)
-    aws = AWSIntegration(region=region, access_token=token)
-    accounts = aws.get_account_list(
-        spelling=args.spelling, separator=args.separator, prefix=args.prefix
+    selector = RoleSelector(
+        preferences=args.role_preference,
+        overrides=args.role_overrides,
+        per_role=args.profile_per_role,
+        prompt=not args.no_prompt,
     )
-    configure_credentials_file(accounts, url, region)
+    configure_credentials_file(
+        organizations,
+        prune=args.prune,
+        selector=selector,
+        credential_process=daemon_arguments if args.use_credential_process else None,
+    )
+    if failed:
+        exit(1)